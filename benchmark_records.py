@@ -0,0 +1,90 @@
+"""Compare the memory used by resident users stored as dicts and as UserRecords.
+
+Synthetic users are decoded from JSON exactly like data.json is loaded, then kept
+either as the decoded dicts or converted with UserRecord.from_json(). Each run
+happens in a fresh process and reports how much its peak RSS grew, so the figures
+include the conversation text both layouts share. Unix only; the 1M dict run
+needs about 3 GB of memory.
+
+    python benchmark_records.py
+    python benchmark_records.py --sizes 10000 100000 1000000 --turns 6
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import time
+
+from records import Style, UserRecord
+
+WORDS = ["hey", "how", "was", "your", "day", "aiko", "i", "missed", "you", "tell", "me", "about", "it", "haha", "really", "okay"]
+
+def synthetic_user(rng, turns):
+    """Encode one user the way it is stored in data.json."""
+    now = time.time()
+    active = rng.random() < 0.3
+    memory = []
+    for index in range(turns if active else rng.randint(0, 2)):
+        content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        memory.append({"role": "user" if index % 2 == 0 else "assistant", "content": content})
+    return json.dumps({
+        "premium": rng.random() < 0.02,
+        "email": None,
+        "claim_time": None,
+        "style": rng.choice(list(Style.__members__)[1:]) if rng.random() < 0.4 else None,
+        "limit_reached": False,
+        "points": rng.randint(0, 5000),
+        "point_received": rng.random() < 0.1,
+        "last_voted_at": now - rng.randint(0, 40000) if rng.random() < 0.1 else None,
+        "streak": rng.randint(0, 30),
+        "previous_streak": rng.randint(0, 30),
+        "last_interaction": now - rng.randint(0, 30 * 86400),
+        "bond": rng.randint(0, 100),
+        "memory": memory,
+        "summary": None,
+        "decayed_through": int(now // 86400)
+    })
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def build(count, turns, seed, compact):
+    """Build count users and return how many bytes the peak RSS grew by."""
+    rng = random.Random(seed)
+    gc.collect()
+    before = peak_rss()
+    users = {}
+    for user_id in range(count):
+        user_data = json.loads(synthetic_user(rng, turns))
+        users[str(user_id)] = UserRecord.from_json(user_data) if compact else user_data
+    gc.collect()
+    return peak_rss() - before
+
+def measure(count, turns, seed, compact):
+    # A fresh process per run so freed memory from an earlier run can't be reused
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(build, (count, turns, seed, compact))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure dict and UserRecord memory use for synthetic users.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="user counts to measure")
+    parser.add_argument("--turns", type=int, default=8, help="memory turns kept by an active user")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'users':>10} {'dict MB':>10} {'record MB':>10} {'dict B/user':>12} {'record B/user':>14} {'saved':>7}")
+    for count in args.sizes:
+        as_dicts = measure(count, args.turns, args.seed, False)
+        as_records = measure(count, args.turns, args.seed, True)
+        print(
+            f"{count:>10} {as_dicts / 2**20:>10.1f} {as_records / 2**20:>10.1f} "
+            f"{as_dicts / count:>12.0f} {as_records / count:>14.0f} {1 - as_records / as_dicts:>7.0%}"
+        )
+
+if __name__ == "__main__":
+    main()
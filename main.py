@@ -2,44 +2,1157 @@ import hikari
 import lightbulb
 import asyncio
 import aiohttp
+from aiohttp import web
 import os
 import re
 import json
+import sqlite3
+import collections
+import contextlib
+import random
+import heapq
+import itertools
+import hmac
+import socket
+import concurrent.futures
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, APIStatusError
+from records import UserRecord, Style, make_turn, USER, ASSISTANT
 import time
 import datetime
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
 load_dotenv()
 DATA_FILE = 'data.json'
+SQLITE_FILE = os.getenv("SQLITE_FILE", "data.db")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", 30))
+DATA_SNAPSHOTS = int(os.getenv("DATA_SNAPSHOTS", 3))
+VOTE_WINDOW = 12 * 3600  # top.gg votes last 12 hours
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "aiko:")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0)) or None
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+MEMORY_DIR = os.getenv("MEMORY_DIR", "memory")
+
+def json_dumps(obj):
+    """Encode compactly, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+def json_loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def vote_timestamp(value):
+    """Unix timestamp of a vote, accepting the old "%Y-%m-%d %H:%M:%S" local-time strings."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+
+def snapshot_path(path, index):
+    return f"{path}.{index}"
+
+def read_data_file(path):
+    """Read a data file, falling back to the newest readable rotated snapshot.
+
+    A missing file with no snapshots is a fresh install. A corrupt file with no
+    readable snapshot raises instead of silently starting with no users.
+    """
+    candidates = [path] + [snapshot_path(path, index) for index in range(1, DATA_SNAPSHOTS + 1)]
+    corrupt = []
+    for candidate in candidates:
+        try:
+            with open(candidate, 'rb') as file:
+                data = json_loads(file.read())
+        except FileNotFoundError:
+            continue
+        except ValueError:
+            corrupt.append(candidate)
+            continue
+        if corrupt:
+            print(f"Recovered user data from {candidate} after failing to read {', '.join(corrupt)}")
+        if "users" not in data:
+            data["users"] = {}
+        return data
+    if corrupt:
+        raise RuntimeError(f"Could not read user data from {', '.join(corrupt)}")
+    return {"users": {}}
+
+def write_data_file(path, text, snapshots=None):
+    """Atomically replace a data file, keeping `snapshots` (default DATA_SNAPSHOTS) previous versions."""
+    if snapshots is None:
+        snapshots = DATA_SNAPSHOTS
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+
+    if os.path.exists(path):
+        for index in range(snapshots, 1, -1):
+            if os.path.exists(snapshot_path(path, index - 1)):
+                os.replace(snapshot_path(path, index - 1), snapshot_path(path, index))
+        if snapshots > 0:
+            os.replace(path, snapshot_path(path, 1))
+    os.replace(temp_path, path)
+
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+# Storage backends
+#
+# A storage backend is used in two steps. snapshot() runs on the event loop and
+# copies what is needed from a user record (or None for a deleted user); write()
+# then receives those snapshots in the storage executor and does the encoding and
+# disk work without touching live data.
+class JSONStorage:
+    """Stores every user in a single JSON document."""
+    def __init__(self, path):
+        self.path = path
+        self.encoded = {}  # user_id -> encoded JSON of that user, reused between writes
+
+    def load_users(self):
+        users = read_data_file(self.path)["users"]
+        self.encoded = {user_id: json_dumps(user_data) for user_id, user_data in users.items()}
+        return {user_id: UserRecord.from_json(user_data) for user_id, user_data in users.items()}
+
+    def snapshot(self, user_id, user_data):
+        if user_data is None:
+            return None
+        return user_data.to_json()
+
+    def write(self, snapshots):
+        """Re-encode the changed users and rewrite the document from the cached encodings."""
+        for user_id, user_data in snapshots.items():
+            if user_data is None:
+                self.encoded.pop(user_id, None)
+            else:
+                self.encoded[user_id] = json_dumps(user_data)
+        users = ",".join(f"{json_dumps(user_id)}:{encoded}" for user_id, encoded in self.encoded.items())
+        write_data_file(self.path, f'{{"users":{{{users}}}}}')
+
+    def user_ids(self):
+        # The document is rewritten from the users encoded since loading, so these are all it will hold
+        return list(self.encoded)
+
+    def close(self):
+        pass
+
+class SQLiteStorage:
+    """Stores one row per user.
+
+    Conversation turns live in the memory log. The memory table only holds
+    histories written by older versions; they are loaded for migration and each
+    user's rows are dropped the next time their record is written.
+    """
+    COLUMNS = {
+        "premium": bool,
+        "email": None,
+        "claim_time": None,
+        "style": None,
+        "limit_reached": bool,
+        "points": None,
+        "point_received": bool,
+        "last_voted_at": vote_timestamp,
+        "streak": None,
+        "previous_streak": None,
+        "last_interaction": None,
+        "bond": None,
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                premium INTEGER NOT NULL DEFAULT 0,
+                email TEXT,
+                claim_time INTEGER,
+                style TEXT,
+                limit_reached INTEGER NOT NULL DEFAULT 0,
+                points INTEGER NOT NULL DEFAULT 0,
+                point_received INTEGER NOT NULL DEFAULT 0,
+                last_voted_at REAL,
+                streak INTEGER NOT NULL DEFAULT 0,
+                previous_streak INTEGER NOT NULL DEFAULT 0,
+                last_interaction REAL,
+                bond INTEGER NOT NULL DEFAULT 20,
+                extra TEXT
+            );
+            CREATE TABLE IF NOT EXISTS memory (
+                user_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (user_id, seq)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_users_points ON users (points);
+            CREATE INDEX IF NOT EXISTS idx_users_last_interaction ON users (last_interaction);
+        """)
+        self.conn.commit()
+
+    def load_users(self):
+        users = {}
+        columns = list(self.COLUMNS)
+        rows = self.conn.execute(f"SELECT user_id, {', '.join(columns)}, extra FROM users")
+        for row in rows:
+            user_data = {}
+            for column, value in zip(columns, row[1:-1]):
+                cast = self.COLUMNS[column]
+                user_data[column] = cast(value) if cast and value is not None else value
+            if row[-1]:
+                user_data.update(json.loads(row[-1]))
+            users[row[0]] = UserRecord.from_json(user_data)
+
+        for user_id, role, content in self.conn.execute("SELECT user_id, role, content FROM memory ORDER BY user_id, seq"):
+            if user_id in users:
+                user_data = users[user_id]
+                if user_data.memory is None:
+                    user_data.memory = []
+                user_data.memory.append(make_turn(role, content))
+                user_data.memory_count = len(user_data.memory)
+        return users
+
+    def snapshot(self, user_id, user_data):
+        if user_data is None:
+            return None
+        row = user_data.to_json()
+        values = [row.get(column) for column in self.COLUMNS]
+        extra = {key: value for key, value in row.items() if key not in self.COLUMNS}
+        return values, extra
+
+    def write(self, snapshots):
+        """Persist only the given users in a single transaction."""
+        columns = list(self.COLUMNS)
+        with self.conn:
+            for user_id, snapshot in snapshots.items():
+                if snapshot is None:
+                    self.conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+                    self.conn.execute("DELETE FROM memory WHERE user_id = ?", (user_id,))
+                    continue
+                values, extra = snapshot
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO users (user_id, {', '.join(columns)}, extra) "
+                    f"VALUES (?, {', '.join('?' for _ in columns)}, ?)",
+                    [user_id, *values, json.dumps(extra) if extra else None]
+                )
+                self.conn.execute("DELETE FROM memory WHERE user_id = ?", (user_id,))
+
+    def user_ids(self):
+        return [row[0] for row in self.conn.execute("SELECT user_id FROM users")]
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def close(self):
+        self.conn.close()
+
+def migrate_json_to_sqlite(json_path, storage):
+    """Copy every user from a data.json file into an empty SQLite storage."""
+    users = read_data_file(json_path)["users"]
+    storage.write({user_id: storage.snapshot(user_id, UserRecord.from_json(user_data)) for user_id, user_data in users.items()})
+    # Histories go into the old memory table and are moved to the memory log on startup
+    with storage.conn:
+        storage.conn.executemany(
+            "INSERT INTO memory (user_id, seq, role, content) VALUES (?, ?, ?, ?)",
+            [(user_id, seq, turn["role"], turn["content"]) for user_id, user_data in users.items() for seq, turn in enumerate(user_data.get("memory", []))]
+        )
+    print(f"Migrated {len(users)} users from {json_path} to {storage.path}")
+    return len(users)
+
+def create_storage(backend):
+    if backend == "sqlite":
+        storage = SQLiteStorage(SQLITE_FILE)
+        if storage.is_empty() and os.path.exists(DATA_FILE):
+            migrate_json_to_sqlite(DATA_FILE, storage)
+        return storage
+    return JSONStorage(DATA_FILE)
+
+# Leaderboard index
+class RankTreeNode:
+    __slots__ = ("key", "priority", "left", "right", "size")
+
+    def __init__(self, key):
+        self.key = key
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.size = 1
+
+class RankTree:
+    """Order-statistic treap: insert, remove, rank and k-th lookups in O(log n)."""
+    def __init__(self):
+        self.root = None
+
+    def __len__(self):
+        return self.root.size if self.root else 0
+
+    @classmethod
+    def from_sorted(cls, keys):
+        """Build a balanced tree from sorted keys in O(n)."""
+        def build(low, high):
+            if low >= high:
+                return None
+            middle = (low + high) // 2
+            node = RankTreeNode(keys[middle])
+            node.left = build(low, middle)
+            node.right = build(middle + 1, high)
+            node.size = high - low
+            return node
+
+        tree = cls()
+        tree.root = build(0, len(keys))
+        # Hand out priorities in breadth-first order so every parent outranks its children
+        priorities = sorted((random.random() for _ in keys), reverse=True)
+        level, index = [tree.root] if tree.root else [], 0
+        while level:
+            next_level = []
+            for node in level:
+                node.priority = priorities[index]
+                index += 1
+                next_level.extend(child for child in (node.left, node.right) if child is not None)
+            level = next_level
+        return tree
+
+    @staticmethod
+    def size(node):
+        return node.size if node else 0
+
+    def update(self, node):
+        node.size = 1 + self.size(node.left) + self.size(node.right)
+        return node
+
+    def split(self, node, key):
+        """Split into (keys < key, keys >= key)."""
+        if node is None:
+            return None, None
+        if node.key < key:
+            left, right = self.split(node.right, key)
+            node.right = left
+            return self.update(node), right
+        left, right = self.split(node.left, key)
+        node.left = right
+        return left, self.update(node)
+
+    def merge(self, left, right):
+        if left is None or right is None:
+            return left or right
+        if left.priority > right.priority:
+            left.right = self.merge(left.right, right)
+            return self.update(left)
+        right.left = self.merge(left, right.left)
+        return self.update(right)
+
+    def insert(self, key):
+        left, right = self.split(self.root, key)
+        self.root = self.merge(self.merge(left, RankTreeNode(key)), right)
+
+    def remove(self, key):
+        self.root = self.remove_from(self.root, key)
+
+    def remove_from(self, node, key):
+        if node is None:
+            return None
+        if node.key == key:
+            return self.merge(node.left, node.right)
+        if key < node.key:
+            node.left = self.remove_from(node.left, key)
+        else:
+            node.right = self.remove_from(node.right, key)
+        return self.update(node)
+
+    def rank(self, key):
+        """Number of keys smaller than key."""
+        node, count = self.root, 0
+        while node is not None:
+            if node.key < key:
+                count += self.size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return count
+
+    def first(self, count):
+        """The smallest keys in order, at most count of them."""
+        result, stack, node = [], [], self.root
+        while (stack or node is not None) and len(result) < count:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            result.append(node.key)
+            node = node.right
+        return result
+
+class Leaderboard:
+    """Keeps users ranked by points so /top never has to sort every user."""
+    def __init__(self):
+        self.tree = RankTree()
+        self.points = {}
+
+    def rebuild(self, users):
+        self.points = {user_id: user_data.points for user_id, user_data in users.items()}
+        self.tree = RankTree.from_sorted(sorted((-points, user_id) for user_id, points in self.points.items()))
+
+    def update(self, user_id, points):
+        """Move a user to their new position; points=None removes them."""
+        old_points = self.points.get(user_id)
+        if old_points == points:
+            return
+        if old_points is not None:
+            self.tree.remove((-old_points, user_id))
+        if points is None:
+            del self.points[user_id]
+            return
+        self.points[user_id] = points
+        self.tree.insert((-points, user_id))
+
+    def top(self, count):
+        return [user_id for _, user_id in self.tree.first(count)]
+
+    def rank(self, user_id):
+        """1-based rank of a user, or None if they have no record."""
+        if user_id not in self.points:
+            return None
+        return self.tree.rank((-self.points[user_id], user_id)) + 1
+
+# Activity index
+def utc_day(timestamp):
+    """Day number (date ordinal) of a Unix timestamp in UTC."""
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).date().toordinal()
+
+class ActivityIndex:
+    """Buckets users by the UTC day of their last interaction."""
+    def __init__(self):
+        self.days = {}
+        self.buckets = collections.defaultdict(set)
+
+    def rebuild(self, users):
+        self.days = {}
+        self.buckets = collections.defaultdict(set)
+        for user_id, user_data in users.items():
+            self.update(user_id, user_data.last_interaction)
+
+    def update(self, user_id, last_interaction):
+        """Move a user to the bucket of their last interaction; None removes them."""
+        day = utc_day(last_interaction) if last_interaction else None
+        old_day = self.days.get(user_id)
+        if old_day == day:
+            return
+        if old_day is not None:
+            self.buckets[old_day].discard(user_id)
+            if not self.buckets[old_day]:
+                del self.buckets[old_day]
+            del self.days[user_id]
+        if day is not None:
+            self.days[user_id] = day
+            self.buckets[day].add(user_id)
+
+    def users_on(self, day):
+        return set(self.buckets.get(day, ()))
+
+# Shared state
+#
+# State that every worker has to agree on goes through a state backend: the
+# leader lease, the guild count and, when the backend is shared, user records. LocalState keeps it in this process; RedisState keeps it in Redis (or
+# anything speaking its protocol) so several worker processes can share it.
+# Values are strings, as Redis returns them.
+class LocalState:
+    """State for a single worker process."""
+    # Only a backend other processes can see makes the user store write through
+    shared = False
+
+    def __init__(self):
+        self.values = {}  # key -> (value, expires_at or None)
+        self.hashes = collections.defaultdict(dict)
+        self.lists = collections.defaultdict(list)
+        self.subscribers = collections.defaultdict(list)  # channel -> [asyncio.Queue]
+        self.writes = 0
+
+    def live(self, key):
+        entry = self.values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.values[key]
+            return None
+        return entry
+
+    def store(self, key, value, expires_at):
+        self.values[key] = (value, expires_at)
+        self.writes += 1
+        if self.writes % 10000 == 0:
+            now = time.monotonic()
+            self.values = {k: v for k, v in self.values.items() if v[1] is None or v[1] > now}
+
+    async def get(self, key):
+        entry = self.live(key)
+        return None if entry is None else entry[0]
+
+    async def set(self, key, value, ttl=None):
+        self.store(key, str(value), time.monotonic() + ttl if ttl else None)
+
+    async def acquire(self, key, owner, ttl):
+        """Take or renew a lease on `key` for `owner`. False if someone else holds it."""
+        entry = self.live(key)
+        if entry is not None and entry[0] != owner:
+            return False
+        self.store(key, owner, time.monotonic() + ttl)
+        return True
+
+    async def release(self, key, owner):
+        entry = self.live(key)
+        if entry is not None and entry[0] == owner:
+            del self.values[key]
+
+    async def hash_get(self, key, field):
+        return self.hashes[key].get(field)
+
+    async def hash_all(self, key):
+        return dict(self.hashes[key])
+
+    async def hash_update(self, key, values, deleted=()):
+        self.hashes[key].update(values)
+        for field in deleted:
+            self.hashes[key].pop(field, None)
+
+    async def list_range(self, key):
+        return list(self.lists.get(key, ()))
+
+    async def list_append(self, key, values):
+        self.lists[key].extend(values)
+
+    async def list_replace(self, key, values):
+        if values:
+            self.lists[key] = list(values)
+        else:
+            self.lists.pop(key, None)
+
+    async def publish(self, channel, message):
+        for queue in self.subscribers[channel]:
+            queue.put_nowait(message)
+
+    async def subscribe(self, channel):
+        queue = asyncio.Queue()
+        self.subscribers[channel].append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.subscribers[channel].remove(queue)
+
+    async def close(self):
+        pass
+
+class RedisState:
+    """State kept in Redis and shared by every worker using the same server and prefix."""
+    LEASE = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) and 1 or 0
+    """
+    RELEASE = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+    shared = True
+
+    def __init__(self, url, prefix):
+        if redis is None:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)")
+        self.client = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.lease_script = self.client.register_script(self.LEASE)
+        self.release_script = self.client.register_script(self.RELEASE)
+
+    def key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def milliseconds(ttl):
+        return int(ttl * 1000) if ttl else 0
+
+    async def get(self, key):
+        return await self.client.get(self.key(key))
+
+    async def set(self, key, value, ttl=None):
+        await self.client.set(self.key(key), value, px=self.milliseconds(ttl) or None)
+
+    async def acquire(self, key, owner, ttl):
+        return bool(await self.lease_script(keys=[self.key(key)], args=[owner, self.milliseconds(ttl)]))
+
+    async def release(self, key, owner):
+        await self.release_script(keys=[self.key(key)], args=[owner])
+
+    async def hash_get(self, key, field):
+        return await self.client.hget(self.key(key), field)
+
+    async def hash_all(self, key):
+        return await self.client.hgetall(self.key(key))
+
+    async def hash_update(self, key, values, deleted=()):
+        async with self.client.pipeline(transaction=True) as pipe:
+            if values:
+                pipe.hset(self.key(key), mapping=values)
+            if deleted:
+                pipe.hdel(self.key(key), *deleted)
+            await pipe.execute()
+
+    async def list_range(self, key):
+        return await self.client.lrange(self.key(key), 0, -1)
+
+    async def list_append(self, key, values):
+        await self.client.rpush(self.key(key), *values)
+
+    async def list_replace(self, key, values):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(self.key(key))
+            if values:
+                pipe.rpush(self.key(key), *values)
+            await pipe.execute()
+
+    async def publish(self, channel, message):
+        await self.client.publish(self.key(channel), message)
+
+    async def subscribe(self, channel):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.key(channel))
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield message["data"]
+        finally:
+            await pubsub.aclose()
+
+    async def close(self):
+        await self.client.aclose()
+
+def create_state(backend):
+    if backend == "redis":
+        return RedisState(REDIS_URL, REDIS_PREFIX)
+    if backend != "local":
+        raise ValueError(f"Unknown STATE_BACKEND {backend!r}, expected 'local' or 'redis'")
+    if WORKER_COUNT > 1:
+        raise RuntimeError("Running more than one worker needs STATE_BACKEND=redis")
+    return LocalState()
+
+shared_state = create_state(STATE_BACKEND)
+
+# Leader election
+class LeaderElection:
+    """Holds a lease in the shared state so only one worker runs the singleton tasks.
+
+    The leader renews its lease every ttl / 3 seconds. If it stops, another worker
+    takes over once the lease expires, and tasks started with run_while_leader are
+    cancelled on a worker that loses the lease.
+    """
+    def __init__(self, state, key, owner, ttl):
+        self.state = state
+        self.key = key
+        self.owner = owner
+        self.ttl = ttl
+        self.is_leader = False
+        self.changed = asyncio.Event()
+
+    def set_leader(self, is_leader):
+        if is_leader != self.is_leader:
+            self.is_leader = is_leader
+            print(f"Worker {self.owner} {'is now' if is_leader else 'is no longer'} the leader")
+            changed, self.changed = self.changed, asyncio.Event()
+            changed.set()
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    is_leader = await self.state.acquire(self.key, self.owner, self.ttl)
+                except Exception as e:
+                    # Without a renewed lease another worker may already have taken over
+                    print(f"An error occurred while renewing the leader lease: {e}")
+                    is_leader = False
+                self.set_leader(is_leader)
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            self.set_leader(False)
+
+    async def wait_for(self, is_leader):
+        while self.is_leader != is_leader:
+            await self.changed.wait()
+
+    async def run_while_leader(self, factory):
+        """Run factory() whenever this worker is the leader."""
+        while True:
+            await self.wait_for(True)
+            task = asyncio.create_task(factory())
+            demoted = asyncio.create_task(self.wait_for(False))
+            await asyncio.wait({task, demoted}, return_when=asyncio.FIRST_COMPLETED)
+            if task.done():
+                demoted.cancel()
+                return await task
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def release(self):
+        if self.is_leader:
+            await self.state.release(self.key, self.owner)
+            self.set_leader(False)
+
+leader = LeaderElection(shared_state, "leader", WORKER_ID, float(os.getenv("LEADER_LEASE_TTL", 30)))
+
+# Memory log
+class MemoryLog:
+    """Conversation turns kept apart from the user records, one append-only log per user.
+
+    Each log is a file of JSON lines under `path`, or a list in the shared state when
+    workers share one. Recording an exchange appends just its turns; a log is only
+    rewritten when its history is summarized or cleared. File I/O runs in a dedicated
+    single-thread executor, so reads and writes of a log happen in order.
+    """
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-log")
+
+    def file(self, user_id):
+        # Spread the logs over subdirectories so no single directory gets huge
+        return os.path.join(self.path, user_id[-2:], f"{user_id}.jsonl")
+
+    def key(self, user_id):
+        return f"memory:{user_id}"
+
+    def read_file(self, user_id):
+        try:
+            with open(self.file(user_id), 'rb') as file:
+                return file.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def append_file(self, user_id, lines):
+        path = self.file(user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a+b') as file:
+            # Start on a fresh line if a crash cut the last append short
+            if file.tell():
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    file.write(b"\n")
+            file.write("".join(line + "\n" for line in lines).encode())
+
+    def replace_file(self, user_id, lines):
+        path = self.file(user_id)
+        if not lines:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_data_file(path, "".join(line + "\n" for line in lines), snapshots=0)
+
+    async def in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def load(self, user_id):
+        if self.state.shared:
+            lines = await self.state.list_range(self.key(user_id))
+        else:
+            lines = await self.in_executor(self.read_file, user_id)
+        turns = []
+        for line in lines:
+            try:
+                role, content = json_loads(line)
+            except ValueError:
+                continue  # the partial last line of an interrupted append
+            turns.append(make_turn(role, content))
+        return turns
+
+    async def append(self, user_id, turns):
+        lines = [json_dumps([turn.role, turn.content]) for turn in turns]
+        if self.state.shared:
+            await self.state.list_append(self.key(user_id), lines)
+        else:
+            await self.in_executor(self.append_file, user_id, lines)
+
+    async def replace(self, user_id, turns):
+        lines = [json_dumps([turn.role, turn.content]) for turn in turns]
+        if self.state.shared:
+            await self.state.list_replace(self.key(user_id), lines)
+        else:
+            await self.in_executor(self.replace_file, user_id, lines)
+
+    def close(self):
+        self.executor.shutdown()
+
+memory_log = MemoryLog(MEMORY_DIR, shared_state)
+
+# User store
+class UserStore:
+    """Keeps every user resident in memory and flushes changes to storage in batches.
+
+    Encoding and disk writes run in a dedicated single-thread executor so they never
+    block the event loop. Flushes requested while one is already waiting share it.
+
+    With a shared state backend, the records live there instead: locking a user also
+    leases them across workers, refreshes their record before the block and writes it
+    through afterwards, and changes published by other workers keep the resident
+    copy and indexes current. The leader copies the shared records back to storage
+    every flush interval (write_behind), so storage stays a durable copy that at
+    most trails the shared state by that long.
+    """
+    USERS_KEY = "users"
+    CHANGES_CHANNEL = "users:changed"
+
+    def __init__(self, storage, flush_interval, state, worker_id, lease_ttl=30):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.state = state
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.follow_task = None
+        self.unpersisted = None  # users changed since the last write-behind, None unless it runs here
+        self.listeners = []  # callables(user_id, user_data) run when another worker changes a user
+        self.data = None
+        self.dirty = set()
+        self.flush_task = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self.write_lock = asyncio.Lock()
+        self.pending_flush = None
+        self.user_locks = {}  # user_id -> [asyncio.Lock, number of holders and waiters]
+        self.leaderboard = Leaderboard()
+        self.activity = ActivityIndex()
+
+    def load(self):
+        """Return the resident data, reading storage only on first use."""
+        if self.data is None:
+            # Shared records are read by sync() once the event loop is running
+            self.data = {"users": {} if self.state.shared else self.storage.load_users()}
+            self.leaderboard.rebuild(self.data["users"])
+            self.activity.rebuild(self.data["users"])
+        return self.data
+
+    def mark_dirty(self, user_id=None):
+        """Mark a user (or every user when user_id is None) as needing a flush."""
+        self.dirty.add(user_id)
+        self.reindex(user_id)
+
+    def reindex(self, user_id=None):
+        users = self.load()["users"]
+        if user_id is None:
+            self.leaderboard.rebuild(users)
+            self.activity.rebuild(users)
+        elif user_id in users:
+            self.leaderboard.update(user_id, users[user_id].points)
+            self.activity.update(user_id, users[user_id].last_interaction)
+        else:
+            self.leaderboard.update(user_id, None)
+            self.activity.update(user_id, None)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, user_id):
+        """Serialize updates to one user without blocking updates to anyone else."""
+        entry = self.user_locks.get(user_id)
+        if entry is None:
+            entry = self.user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if not self.state.shared:
+                    yield
+                    return
+                async with self.shared_lock(user_id):
+                    yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_locks[user_id]
+
+    @contextlib.asynccontextmanager
+    async def shared_lock(self, user_id):
+        key = f"lock:user:{user_id}"
+        delay = 0.005
+        while not await self.state.acquire(key, self.worker_id, self.lease_ttl):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        try:
+            # Unflushed local changes win over the shared copy
+            if user_id not in self.dirty and None not in self.dirty:
+                await self.refresh(user_id)
+            yield
+        finally:
+            try:
+                if user_id in self.dirty:
+                    self.dirty.discard(user_id)
+                    await self.write_shared({user_id})
+            finally:
+                await self.state.release(key, self.worker_id)
+
+    async def refresh(self, user_id):
+        """Replace the resident copy of a user with the shared one."""
+        encoded = await self.state.hash_get(self.USERS_KEY, user_id)
+        users = self.load()["users"]
+        if encoded is None:
+            users.pop(user_id, None)
+        else:
+            users[user_id] = UserRecord.from_json(json_loads(encoded))
+        self.reindex(user_id)
+        return users.get(user_id)
+
+    async def sync(self):
+        """Load every shared record, seeding the shared state from storage if it is empty."""
+        if not self.state.shared:
+            return
+        encoded = await self.state.hash_all(self.USERS_KEY)
+        if encoded:
+            users = {user_id: UserRecord.from_json(json_loads(value)) for user_id, value in encoded.items()}
+        else:
+            users = await asyncio.get_running_loop().run_in_executor(self.executor, self.storage.load_users)
+            if users:
+                await self.state.hash_update(self.USERS_KEY, {user_id: json_dumps(user_data.to_json()) for user_id, user_data in users.items()})
+                print(f"Seeded shared state with {len(users)} users from storage")
+        resident = self.load()["users"]
+        for user_id, user_data in users.items():
+            if user_id not in self.dirty:
+                resident[user_id] = user_data
+        self.reindex()
+
+    async def write_shared(self, dirty):
+        users = self.data["users"]
+        values = {user_id: json_dumps(users[user_id].to_json()) for user_id in dirty if user_id in users}
+        deleted = [user_id for user_id in dirty if user_id not in users]
+        try:
+            await self.state.hash_update(self.USERS_KEY, values, deleted)
+        except Exception:
+            self.dirty |= dirty
+            raise
+        if self.unpersisted is not None:
+            self.unpersisted |= dirty
+        await self.state.publish(self.CHANGES_CHANNEL, " ".join([self.worker_id, *dirty]))
+
+    async def follow(self):
+        """Apply user changes published by other workers to the resident data and indexes."""
+        while True:
+            try:
+                async for message in self.state.subscribe(self.CHANGES_CHANNEL):
+                    worker_id, *user_ids = message.split(" ")
+                    if worker_id == self.worker_id:
+                        continue
+                    if self.unpersisted is not None:
+                        self.unpersisted.update(user_ids)
+                    for user_id in user_ids:
+                        # Locked users are refreshed when their lock is taken anyway
+                        if user_id in self.dirty or user_id in self.user_locks:
+                            continue
+                        user_data = await self.refresh(user_id)
+                        for listener in self.listeners:
+                            listener(user_id, user_data)
+            except Exception as e:
+                print(f"An error occurred while following shared user changes: {e}")
+                await asyncio.sleep(5)
+                # Changes published while disconnected were missed
+                with contextlib.suppress(Exception):
+                    await self.sync()
+
+    async def write_behind(self):
+        """Copy shared records to storage every flush interval. Run only on the leader."""
+        # Changes made before this worker led were not collected, so the first pass copies everyone
+        self.unpersisted = set()
+        everyone = True
+        try:
+            while True:
+                try:
+                    await self.persist(everyone)
+                    everyone = False
+                except Exception as e:
+                    print(f"An error occurred while writing shared users to storage: {e}")
+                await asyncio.sleep(self.flush_interval)
+        finally:
+            self.unpersisted = None
+
+    async def persist(self, everyone=False):
+        pending, self.unpersisted = self.unpersisted, set()
+        loop = asyncio.get_running_loop()
+        if everyone:
+            encoded = await self.state.hash_all(self.USERS_KEY)
+            stored = await loop.run_in_executor(self.executor, self.storage.user_ids)
+            encoded.update((user_id, None) for user_id in stored if user_id not in encoded)
+        else:
+            encoded = {user_id: await self.state.hash_get(self.USERS_KEY, user_id) for user_id in pending}
+        snapshots = {
+            user_id: self.storage.snapshot(user_id, None if value is None else UserRecord.from_json(json_loads(value)))
+            for user_id, value in encoded.items()
+        }
+        if not snapshots:
+            return
+        try:
+            await loop.run_in_executor(self.executor, self.storage.write, snapshots)
+        except Exception:
+            self.unpersisted |= pending
+            raise
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, user_id):
+        """Lock a user and yield their record, creating it if needed and bringing
+        bond decay up to date. The record is marked dirty afterwards."""
+        async with self.lock(user_id):
+            try:
+                user_data = create_user(self.load(), user_id)
+                apply_daily_decay(user_data)
+                yield user_data
+            finally:
+                self.mark_dirty(user_id)
+
+    async def flush(self):
+        """Write the users changed since the last flush off the event loop."""
+        if self.pending_flush is None:
+            self.pending_flush = asyncio.ensure_future(self.write_pending())
+        await asyncio.shield(self.pending_flush)
+
+    async def write_pending(self):
+        async with self.write_lock:
+            # Anyone calling flush() from here on needs a newer snapshot than this one.
+            self.pending_flush = None
+            if not self.dirty or self.data is None:
+                return
+            users = self.data["users"]
+            if None in self.dirty:
+                self.dirty = set(users) | (self.dirty - {None})
+            if self.state.shared:
+                # Only write a user through while holding their lease, which does so on release
+                for user_id in list(self.dirty):
+                    async with self.lock(user_id):
+                        pass
+                return
+            dirty, self.dirty = self.dirty, set()
+            snapshots = {user_id: self.storage.snapshot(user_id, users.get(user_id)) for user_id in dirty}
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.storage.write, snapshots)
+            except Exception:
+                self.dirty |= dirty
+                raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"An error occurred while flushing user data: {e}")
+
+    def start(self):
+        """Start the periodic flush task."""
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.run())
+        if self.state.shared and self.follow_task is None:
+            self.follow_task = asyncio.create_task(self.follow())
+
+    async def close(self):
+        """Stop the periodic flush task, write any pending changes and close storage."""
+        for task in (self.flush_task, self.follow_task):
+            if task is not None:
+                task.cancel()
+        self.flush_task = self.follow_task = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.storage.close)
+        self.executor.shutdown()
+
+user_store = UserStore(create_storage(STORAGE_BACKEND), FLUSH_INTERVAL, shared_state, WORKER_ID)
 
 def load_data():
-    try:
-        with open(DATA_FILE, 'r') as file:
-            data = json.load(file)
-            if "users" not in data:
-                data["users"] = {}
-            return data
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"users": {}}
-
-def save_data(data):
-    with open(DATA_FILE, 'w') as file:
-        json.dump(data, file, indent=4)
+    return user_store.load()
+
+def save_data(data, user_id=None):
+    user_store.mark_dirty(user_id)
 
 def update_data(new_data):
     data = load_data()
     if "users" in new_data:
-        data["users"].update(new_data["users"])
-    save_data(data)
+        for user_id, user_data in new_data["users"].items():
+            data["users"][user_id] = UserRecord.from_json(user_data) if isinstance(user_data, dict) else user_data
+            save_data(data, user_id)
 
 data = load_data()
 
-# Nonpersistent data
-prem_email = []
-user_reset_time = {}
-user_response_count = {}
-user_limit_reached = {}
+# Metrics
+METRICS_REPORT_INTERVAL = float(os.getenv("METRICS_REPORT_INTERVAL", 600))
+metric_reports = []  # callables returning a one-line summary, printed every METRICS_REPORT_INTERVAL
+
+class LatencyStats:
+    """Keeps the most recent latency samples (in seconds) and reports percentiles."""
+    def __init__(self, name, max_samples=1000):
+        self.name = name
+        self.samples = collections.deque(maxlen=max_samples)
+        metric_reports.append(self.summary)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def summary(self):
+        if not self.samples:
+            return None
+        return (
+            f"{self.name}: p50 {self.percentile(50) * 1000:.1f}ms, p95 {self.percentile(95) * 1000:.1f}ms, "
+            f"p99 {self.percentile(99) * 1000:.1f}ms ({len(self.samples)} samples)"
+        )
+
+async def report_metrics():
+    while True:
+        await asyncio.sleep(METRICS_REPORT_INTERVAL)
+        for report in metric_reports:
+            line = report()
+            if line:
+                print(line)
+
+# Event loop lag
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from short sleeps."""
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.stats = LatencyStats("Event loop lag", max_samples=1200)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.stats.record(max(0.0, loop.time() - start - self.interval))
+
+loop_lag_monitor = LoopLagMonitor()
 
 BOND_LEVELS = {
     1: "Acquaintance",
@@ -182,112 +1295,605 @@ DERE_TYPES = {
 }
 
 bot = lightbulb.BotApp(token=os.getenv("BOT_TOKEN"))
-openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+def worker_shard_ids(shard_count, worker_count, worker_index):
+    """The contiguous range of shards this worker runs, or None to run them all."""
+    if worker_count == 1:
+        return None
+    if shard_count is None:
+        raise RuntimeError("SHARD_COUNT must be set when WORKER_COUNT is more than 1")
+    per_worker = -(-shard_count // worker_count)
+    shard_ids = list(range(worker_index * per_worker, min(shard_count, (worker_index + 1) * per_worker)))
+    if not shard_ids:
+        raise RuntimeError(f"Worker {worker_index} has no shards; use fewer workers than SHARD_COUNT")
+    return shard_ids
+
+# Retries are handled by CompletionPolicy, which knows the caller's deadline
+openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+# HTTP
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures so calls fail fast for `reset_timeout`
+    seconds, then lets a single trial call through to decide whether to close again."""
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.opened_at = time.monotonic()  # Hold everyone else back until the trial call finishes
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+class HTTPClient:
+    """Shared aiohttp session with a bounded connection pool and DNS cache.
+
+    Requests get a timeout and are retried with jittered exponential backoff on
+    connection errors, 429 and 5xx, honouring Retry-After.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, limit, limit_per_host, dns_ttl, keepalive_timeout, timeout, retries, backoff, max_backoff):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = None
+
+    async def setup(self):
+        """Initialize the aiohttp.ClientSession in an async context."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def request(self, method, url, breaker=None, **kwargs):
+        """Send a request and return (status, decoded JSON or None).
+
+        Raises CircuitOpenError without sending anything while the breaker is open.
+        """
+        if not self.session:
+            raise RuntimeError("Client session is not initialized. Call setup() first.")
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(url)
+
+        for attempt in range(self.retries + 1):
+            response = None
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    if response.status not in self.RETRY_STATUSES:
+                        data = await response.json(content_type=None) if response.status == 200 else None
+                        if breaker is not None:
+                            breaker.record_success()
+                        return response.status, data
+                    if attempt == self.retries:
+                        if breaker is not None:
+                            breaker.record_failure()
+                        return response.status, None
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                if attempt == self.retries:
+                    if breaker is not None:
+                        breaker.record_failure()
+                    raise
+            await asyncio.sleep(self.retry_delay(attempt, response))
+
+    async def close(self):
+        """Close the aiohttp.ClientSession."""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+http_client = HTTPClient(
+    limit=int(os.getenv("HTTP_POOL_LIMIT", 20)),
+    limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 10)),
+    dns_ttl=int(os.getenv("HTTP_DNS_TTL", 300)),
+    keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30)),
+    timeout=float(os.getenv("HTTP_TIMEOUT", 5)),
+    retries=int(os.getenv("HTTP_RETRIES", 2)),
+    backoff=float(os.getenv("HTTP_BACKOFF", 0.5)),
+    max_backoff=float(os.getenv("HTTP_MAX_BACKOFF", 5))
+)
 
 # Top.gg
 class TopGGClient:
-    def __init__(self, bot, token):
+    def __init__(self, bot, token, http, base_url, positive_ttl, negative_ttl, default_vote):
         self.bot = bot
         self.token = token
-        self.session = None
+        self.http = http
+        self.base_url = base_url.rstrip("/")
+        # The check API doesn't say when a vote was made, so its answers are only kept briefly
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        # What to assume about a vote while Top.gg is unreachable
+        self.default_vote = default_vote
+        self.breaker = CircuitBreaker(
+            threshold=int(os.getenv("TOPGG_BREAKER_THRESHOLD", 5)),
+            reset_timeout=float(os.getenv("TOPGG_BREAKER_RESET", 60))
+        )
+        self.votes = {}  # user_id -> (voted, expires_at)
 
-    async def setup(self):
-        """Initialize the aiohttp.ClientSession in an async context."""
-        self.session = aiohttp.ClientSession()
+    def record_vote(self, user_id, voted_at=None):
+        """Remember a vote pushed by the webhook for the rest of its 12 hour window."""
+        self.cache_vote(user_id, True, (voted_at or time.time()) + VOTE_WINDOW)
+
+    def cache_vote(self, user_id, voted, expires_at):
+        self.votes[str(user_id)] = (voted, expires_at)
+        if len(self.votes) > 100000:
+            now = time.time()
+            self.votes = {key: value for key, value in self.votes.items() if value[1] > now}
+
+    def cached_vote(self, user_id):
+        """The cached vote state of a user, or None if it is unknown or stale."""
+        entry = self.votes.get(str(user_id))
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
 
     async def post_guild_count(self, count):
         """Post the guild count to Top.gg."""
-        if not self.session:
-            raise RuntimeError("Client session is not initialized. Call setup() first.")
-        url = f"https://top.gg/api/bots/{self.bot.get_me().id}/stats"
+        url = f"{self.base_url}/bots/{self.bot.get_me().id}/stats"
         headers = {"Authorization": self.token}
         payload = {"server_count": count}
-        async with self.session.post(url, json=payload, headers=headers) as response:
-            if response.status != 200:
-                print(f"Failed to post guild count to Top.gg: {response.status}")
-            else:
-                print("Posted server count to Top.gg")
+        try:
+            status, _ = await self.http.request("POST", url, breaker=self.breaker, json=payload, headers=headers)
+        except Exception as e:
+            print(f"Failed to post guild count to Top.gg: {e!r}")
+            return
+        if status != 200:
+            print(f"Failed to post guild count to Top.gg: {status}")
+        else:
+            print("Posted server count to Top.gg")
 
     async def get_user_vote(self, user_id):
-        """Check if a user has voted for the bot on Top.gg."""
-        if not self.session:
-            raise RuntimeError("Client session is not initialized. Call setup() first.")
-        url = f"https://top.gg/api/bots/{self.bot.get_me().id}/check?userId={user_id}"
+        """Check if a user has voted for the bot on Top.gg, using the vote cache when possible."""
+        cached = self.cached_vote(user_id)
+        if cached is not None:
+            return cached
+        url = f"{self.base_url}/bots/{self.bot.get_me().id}/check?userId={user_id}"
         headers = {"Authorization": self.token}
         try:
-            async with self.session.get(url, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get('voted') == 1
-                else:
-                    print(f"Failed to check user vote: {response.status}")
-                    return False
+            status, data = await self.http.request("GET", url, breaker=self.breaker, headers=headers)
+        except CircuitOpenError:
+            return self.default_vote
         except Exception as e:
-            print(f"An error occurred while checking user vote: {e}")
-            return False
+            print(f"An error occurred while checking user vote: {e!r}")
+            return self.default_vote
 
-    async def close(self):
-        """Close the aiohttp.ClientSession."""
-        if self.session:
-            await self.session.close()
+        if status != 200 or data is None:
+            print(f"Failed to check user vote: {status}")
+            return self.default_vote
+        voted = data.get('voted') == 1
+        self.cache_vote(user_id, voted, time.time() + (self.positive_ttl if voted else self.negative_ttl))
+        return voted
 
 topgg_token = os.getenv("TOPGG_TOKEN")
-topgg_client = TopGGClient(bot, topgg_token)
+topgg_client = TopGGClient(
+    bot,
+    topgg_token,
+    http_client,
+    base_url=os.getenv("TOPGG_API_URL", "https://top.gg/api"),
+    positive_ttl=float(os.getenv("TOPGG_POSITIVE_VOTE_TTL", 600)),
+    negative_ttl=float(os.getenv("TOPGG_NEGATIVE_VOTE_TTL", 60)),
+    default_vote=os.getenv("TOPGG_DEFAULT_VOTE", "false").lower() == "true"
+)
+
+# Premium emails
+class PremiumEmailStore:
+    """Durable list of paid emails waiting to be claimed with /claim.
+
+    Emails are normalized and are the table's primary key, so lookups are indexed.
+    Unclaimed entries expire after `ttl` seconds. Claiming is a single conditional
+    UPDATE, so concurrent claims of the same email (from any process sharing the
+    file) cannot both win, and claiming again as the same user succeeds again.
+    Database work runs in a dedicated thread to keep it off the event loop.
+    """
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS premium_emails (
+                email TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                reference TEXT,
+                added_at REAL NOT NULL,
+                expires_at REAL,
+                claimed_by TEXT,
+                claimed_at REAL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_premium_emails_unclaimed ON premium_emails (expires_at) WHERE claimed_by IS NULL;
+        """)
+        self.conn.commit()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="premium-emails")
+
+    @staticmethod
+    def normalize(email):
+        return email.strip().casefold()
+
+    async def call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _add(self, email, source, reference):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        with self.conn:
+            added = self.conn.execute(
+                "INSERT OR IGNORE INTO premium_emails (email, source, reference, added_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (email, source, reference, now, expires_at)
+            ).rowcount == 1
+            if not added:
+                # A repeated payment renews an entry that is still waiting to be claimed
+                self.conn.execute(
+                    "UPDATE premium_emails SET source = ?, reference = ?, added_at = ?, expires_at = ? WHERE email = ? AND claimed_by IS NULL",
+                    (source, reference, now, expires_at, email)
+                )
+        return added
+
+    async def add(self, email, source, reference=None):
+        """Add an email; False if it was already known."""
+        return await self.call(self._add, self.normalize(email), source, reference)
+
+    def _claim(self, email, user_id):
+        now = time.time()
+        with self.conn:
+            claimed = self.conn.execute(
+                "UPDATE premium_emails SET claimed_by = ?, claimed_at = ? "
+                "WHERE email = ? AND claimed_by IS NULL AND (expires_at IS NULL OR expires_at > ?)",
+                (user_id, now, email, now)
+            ).rowcount == 1
+        if claimed:
+            return True
+        row = self.conn.execute("SELECT claimed_by FROM premium_emails WHERE email = ?", (email,)).fetchone()
+        return row is not None and row[0] == user_id
+
+    async def claim(self, email, user_id):
+        """Claim an email for a user. True if it is (or already was) theirs."""
+        return await self.call(self._claim, self.normalize(email), user_id)
+
+    def _purge(self):
+        with self.conn:
+            return self.conn.execute(
+                "DELETE FROM premium_emails WHERE claimed_by IS NULL AND expires_at <= ?", (time.time(),)
+            ).rowcount
+
+    async def run(self):
+        """Delete expired unclaimed emails every hour."""
+        while True:
+            await asyncio.sleep(3600)
+            try:
+                purged = await self.call(self._purge)
+                if purged:
+                    print(f"Removed {purged} unclaimed premium emails that expired")
+            except Exception as e:
+                print(f"An error occurred while removing expired premium emails: {e}")
+
+    async def close(self):
+        await self.call(self.conn.close)
+        self.executor.shutdown()
+
+premium_emails = PremiumEmailStore(
+    os.getenv("PREMIUM_EMAILS_FILE", "premium_emails.db"),
+    ttl=float(os.getenv("PREMIUM_EMAIL_TTL", 30 * 86400))
+)
+
+# Webhooks
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 0))  # 0 disables the webhook server
+TOPGG_WEBHOOK_PATH = os.getenv("TOPGG_WEBHOOK_PATH", "/topgg")
+TOPGG_WEBHOOK_AUTH = os.getenv("TOPGG_WEBHOOK_AUTH")
+KOFI_WEBHOOK_PATH = os.getenv("KOFI_WEBHOOK_PATH", "/kofi")
+KOFI_VERIFICATION_TOKEN = os.getenv("KOFI_VERIFICATION_TOKEN")
+
+webhook_app = web.Application()
+webhook_runner = None
+
+async def start_webhooks():
+    global webhook_runner
+    if not WEBHOOK_PORT:
+        return
+    webhook_runner = web.AppRunner(webhook_app)
+    await webhook_runner.setup()
+    await web.TCPSite(webhook_runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    print(f"Listening for webhooks on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+async def stop_webhooks():
+    if webhook_runner is not None:
+        await webhook_runner.cleanup()
+
+async def topgg_webhook(request):
+    """Receive vote pushes from Top.gg and fill the vote cache."""
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), TOPGG_WEBHOOK_AUTH):
+        return web.Response(status=401)
+    try:
+        payload = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    # Test pushes from the Top.gg dashboard are acknowledged but aren't votes
+    if payload.get("type") == "upvote" and payload.get("user"):
+        topgg_client.record_vote(payload["user"])
+    return web.Response(status=200)
+
+# Without a secret anyone could push fake votes, so the route needs one
+if TOPGG_WEBHOOK_AUTH:
+    webhook_app.router.add_post(TOPGG_WEBHOOK_PATH, topgg_webhook)
+
+async def kofi_webhook(request):
+    """Receive Ko-fi payment notifications and queue subscribers' emails for /claim."""
+    try:
+        form = await request.post()
+        payload = json_loads(form.get("data", ""))
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(payload, dict):
+        return web.Response(status=400)
+    if not hmac.compare_digest(str(payload.get("verification_token", "")), KOFI_VERIFICATION_TOKEN):
+        return web.Response(status=401)
+    email = payload.get("email")
+    # Ko-fi retries anything but a 200, so ignored payment types still get one
+    if payload.get("type") == "Subscription" and email and "@" in email:
+        reference = payload.get("kofi_transaction_id")
+        if await premium_emails.add(email, "kofi", reference):
+            audit_log.log(f"Email `{email}` added from Ko-fi ({payload.get('tier_name') or 'subscription'}).")
+    return web.Response(status=200)
+
+# Without a token anyone could grant premium, so the endpoint only exists once one is set
+if KOFI_VERIFICATION_TOKEN:
+    webhook_app.router.add_post(KOFI_WEBHOOK_PATH, kofi_webhook)
+
+# Audit log
+class AuditLog:
+    """Collects admin log lines on a queue and posts them in batches, so logging never adds a
+    REST call to a command's response path. Lines are dropped (and counted) when the queue is full.
+
+    Batches go to a Discord webhook when one is configured, otherwise to the admin channel.
+    """
+    MESSAGE_LIMIT = 2000
+
+    def __init__(self, channel_id, webhook_url, interval, batch_size, max_queue):
+        self.channel_id = channel_id
+        self.webhook_url = webhook_url
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+    def log(self, text):
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def command(self, ctx):
+        guild = ctx.get_guild()
+        self.log(f"`{ctx.command.name}` invoked in `{guild.name if guild else 'DMs'}` by `{ctx.author.id}`.")
+
+    def drain(self, batch):
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            self.drain(batch)
+            await self.send(batch)
+
+    def chunks(self, lines):
+        chunk = ""
+        for line in lines:
+            line = line[:self.MESSAGE_LIMIT]
+            if chunk and len(chunk) + len(line) + 1 > self.MESSAGE_LIMIT:
+                yield chunk
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line
+        if chunk:
+            yield chunk
+
+    async def send(self, lines):
+        if self.dropped:
+            lines.append(f"({self.dropped} audit events dropped)")
+            self.dropped = 0
+        for chunk in self.chunks(lines):
+            try:
+                if self.webhook_url:
+                    await http_client.request("POST", self.webhook_url, json={"content": chunk, "allowed_mentions": {"parse": []}})
+                else:
+                    await bot.rest.create_message(self.channel_id, chunk)
+            except Exception as e:
+                print(f"Error sending audit log: {e}")
+
+    async def close(self):
+        """Send whatever is still queued."""
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self.send(batch)
+
+audit_log = AuditLog(
+    channel_id=int(os.getenv("AUDIT_LOG_CHANNEL", 1285303262127325301)),
+    webhook_url=os.getenv("AUDIT_LOG_WEBHOOK_URL"),
+    interval=float(os.getenv("AUDIT_LOG_INTERVAL", 5)),
+    batch_size=int(os.getenv("AUDIT_LOG_BATCH_SIZE", 20)),
+    max_queue=int(os.getenv("AUDIT_LOG_MAX_QUEUE", 1000))
+)
+
+# Startup
+@bot.listen(hikari.StartingEvent)
+async def on_preparing(event: hikari.StartingEvent):
+    # Runs before the shards connect, so no message or command can touch a user
+    # whose history still has to be moved to the memory log
+    await user_store.sync()
+    # Token counts of migrated histories need the tokenizer
+    await asyncio.to_thread(memory_manager.get_encoding)
+    await memory_manager.migrate()
 
 # Presence
 @bot.listen(hikari.StartedEvent)
 async def on_starting(event: hikari.StartedEvent):
-    await topgg_client.setup()
-    asyncio.create_task(daily_maintenance())
-    asyncio.create_task(check_vote_expiration())
+    await http_client.setup()
+    await start_webhooks()
+    user_store.start()
+    asyncio.create_task(loop_lag_monitor.run())
+    asyncio.create_task(report_metrics())
+    asyncio.create_task(audit_log.run())
+    asyncio.create_task(dm_limiter.run())
+    asyncio.create_task(premium_emails.run())
+    asyncio.create_task(memory_manager.run())
+    asyncio.create_task(leader.run())
+    asyncio.create_task(leader.run_while_leader(daily_maintenance))
+    asyncio.create_task(leader.run_while_leader(check_vote_expiration))
+    asyncio.create_task(leader.run_while_leader(report_guild_count))
+    if shared_state.shared:
+        asyncio.create_task(leader.run_while_leader(user_store.write_behind))
+    # Every worker sets the presence of its own shards from the count the leader shares
+    while True:
+        server_count = await shared_state.get("guild_count")
+        await update_presence(int(server_count) if server_count else len(bot.cache.get_guilds_view()))
+        await asyncio.sleep(3600)
+
+async def update_presence(server_count):
+    await bot.update_presence(
+        activity=hikari.Activity(
+            name=f"{server_count} servers! | /help",
+            type=hikari.ActivityType.WATCHING,
+        )
+    )
+
+async def report_guild_count():
+    """Count the guilds for every worker and report them to Top.gg, starting as soon as this worker leads."""
     while True:
         guilds = await bot.rest.fetch_my_guilds()
         server_count = len(guilds)
-        await bot.update_presence(
-            activity=hikari.Activity(
-                name=f"{server_count} servers! | /help",
-                type=hikari.ActivityType.WATCHING,
-            )
-        )
+        await shared_state.set("guild_count", server_count)
+        await update_presence(server_count)
         await topgg_client.post_guild_count(server_count)
         await asyncio.sleep(3600)
 
-# Email
+# Message routing
+class MessageRouter:
+    """Runs a single MessageCreateEvent listener and hands each message only to the handlers
+    whose predicates match. Predicates must be cheap checks on the event itself (no I/O)
+    so messages that don't concern Aiko are dropped straight away.
+    """
+    def __init__(self):
+        self.routes = []
+
+    def route(self, predicate):
+        def decorator(handler):
+            self.routes.append((predicate, handler))
+            return handler
+        return decorator
+
+    async def dispatch(self, event):
+        for predicate, handler in self.routes:
+            if predicate(event):
+                await handler(event)
+
+message_router = MessageRouter()
+
 @bot.listen(hikari.MessageCreateEvent)
+async def on_message_create(event: hikari.MessageCreateEvent) -> None:
+    await message_router.dispatch(event)
+
+def is_dm(event):
+    return getattr(event, "guild_id", None) is None
+
+def is_own_message(event):
+    me = bot.get_me()
+    return me is not None and event.message.author.id == me.id
+
+def in_channel(channel_id):
+    return lambda event: event.channel_id == channel_id
+
+def may_address_aiko(event):
+    """DMs, mentions and replies from users. Replies still need to be checked against the referenced message."""
+    if event.message.author.is_bot:
+        return False
+    if is_dm(event) or event.message.message_reference is not None:
+        return True
+    me = bot.get_me()
+    return me is not None and f"<@{me.id}>" in (event.message.content or "")
+
+@message_router.route(is_own_message)
+async def on_own_message(event: hikari.MessageCreateEvent) -> None:
+    reference_resolver.remember(event.message.id)
+
+# Email
+@message_router.route(in_channel(1285293959655981196))
 async def on_message(event: hikari.MessageCreateEvent) -> None:
-    if event.channel_id == 1285293959655981196:
-        message_content = event.message.content
-        if message_content is None:
-            return
-        message_content = message_content.strip() 
-        pattern = r'<@\d+>\s*(\S+@[\S]+\.[a-z]{2,6})'
-        match = re.match(pattern, message_content)
-        if match:
-            email = match.group(1)
-            if re.match(r"[^@]+@[^@]+\.[^@]+", email):
-                if email not in prem_email:
-                    prem_email.append(email)
-                    await bot.rest.create_message(1285303262127325301, f"Email `{email}` added to the list.")
-                else:
-                    await bot.rest.create_message(1285303262127325301, f"Email `{email}` is already in the list.")
+    message_content = event.message.content
+    if message_content is None:
+        return
+    message_content = message_content.strip() 
+    pattern = r'<@\d+>\s*(\S+@[\S]+\.[a-z]{2,6})'
+    match = re.match(pattern, message_content)
+    if match:
+        email = match.group(1)
+        if re.match(r"[^@]+@[^@]+\.[^@]+", email):
+            if await premium_emails.add(email, "discord"):
+                audit_log.log(f"Email `{email}` added to the list.")
             else:
-                await bot.rest.create_message(1285303262127325301, "Invalid email format.")
+                audit_log.log(f"Email `{email}` is already in the list.")
+        else:
+            audit_log.log("Invalid email format.")
 
 # Join event
 @bot.listen(hikari.GuildJoinEvent)
 async def on_guild_join(event):
     guild = event.get_guild()
     if guild is not None:
-        await bot.rest.create_message(1285303262127325301, f"Joined `{guild.name}`.")
+        audit_log.log(f"Joined `{guild.name}`.")
     else:
-        await bot.rest.create_message(1285303262127325301, "Joined unknown server.")
+        audit_log.log("Joined unknown server.")
 
 # Leave event
 @bot.listen(hikari.GuildLeaveEvent)
 async def on_guild_leave(event):
     guild = event.old_guild
     if guild is not None:
-        await bot.rest.create_message(1285303262127325301, f"Left `{guild.name}`.")
+        audit_log.log(f"Left `{guild.name}`.")
 
 # Create user
 def create_user(data, user_id):
@@ -296,181 +1902,1123 @@ def create_user(data, user_id):
         data["users"] = {}
 
     if user_id not in data["users"]:
-        data["users"][user_id] = {
-            "premium": False,
-            "email": None,
-            "claim_time": None,
-            "style": None,
-            "limit_reached": False,
-            "points": 0,
-            "point_received": False,
-            "last_voted_at": None,
-            "streak": 0,
-            "previous_streak": 0,
-            "last_interaction": None,
-            "bond": 20,
-            "memory": []
-        }
-        save_data(data)
+        data["users"][user_id] = UserRecord()
+        save_data(data, user_id)
 
     return data["users"][user_id]
 
 # Mechanisms----------------------------------------------------------------------------------------------------------------------------------------
 
+# Completion scheduling
+class CompletionBusy(Exception):
+    """Raised when a completion cannot start soon enough, so the caller can answer right away."""
+
+class CompletionScheduler:
+    """Admits OpenAI calls under a concurrency cap and a tokens-per-minute budget.
+
+    Waiting calls are served premium first, then free, then background work. Within a
+    priority, users take turns, so one user's queued messages cannot starve everyone else.
+    A call is rejected up front when the queue is full, the user already has too many
+    waiting, or the token budget would not free up within `max_wait` seconds.
+    """
+    PREMIUM, FREE, BACKGROUND = 0, 1, 2
+    WINDOW = 60
+
+    def __init__(self, max_concurrent, tokens_per_minute, max_queue, max_per_user, max_wait):
+        self.max_concurrent = max_concurrent
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_wait = max_wait
+        self.active = 0
+        self.usage = collections.deque()  # [started_at, tokens] reserved within the last WINDOW seconds
+        self.window_tokens = 0
+        self.queues = [collections.OrderedDict() for _ in range(3)]  # user_id -> deque of (future, tokens)
+        self.queued = 0
+        self.wakeup = None
+        self.rejected = 0
+        self.wait_stats = LatencyStats("OpenAI queue wait")
+        metric_reports.append(self.summary)
+
+    def prune(self):
+        cutoff = time.monotonic() - self.WINDOW
+        while self.usage and self.usage[0][0] <= cutoff:
+            self.window_tokens -= self.usage.popleft()[1]
+
+    def budget_free_in(self, tokens):
+        """Seconds until `tokens` more would fit in the token budget."""
+        self.prune()
+        excess = self.window_tokens + tokens - self.tokens_per_minute
+        if excess <= 0 or not self.usage:
+            return 0.0
+        for started_at, reserved in self.usage:
+            excess -= reserved
+            if excess <= 0:
+                break
+        return max(0.0, started_at + self.WINDOW - time.monotonic())
+
+    def can_start(self, tokens):
+        # A single call larger than the whole budget may still run once the window is empty
+        return self.active < self.max_concurrent and self.budget_free_in(tokens) == 0
+
+    def start(self, tokens):
+        self.active += 1
+        return self.charge(tokens)
+
+    def charge(self, tokens):
+        entry = [time.monotonic(), tokens]
+        self.usage.append(entry)
+        self.window_tokens += tokens
+        return entry
+
+    def settle(self, entry, used_tokens):
+        """Replace a reservation's estimate with the tokens actually used."""
+        if entry in self.usage:
+            self.window_tokens += used_tokens - entry[1]
+            entry[1] = used_tokens
+
+    def reserve(self, tokens):
+        """Charge an extra call made inside a held slot, if nobody is waiting and the budget has room now."""
+        if self.queued or self.budget_free_in(tokens) > 0:
+            return None
+        return self.charge(tokens)
+
+    def next_waiter(self):
+        for queue in self.queues:
+            while queue:
+                user_id, waiters = next(iter(queue.items()))
+                future, tokens = waiters[0]
+                if future.done():
+                    waiters.popleft()
+                    self.queued -= 1
+                    if not waiters:
+                        del queue[user_id]
+                    continue
+                return queue, user_id, waiters
+        return None
+
+    def admit(self):
+        while True:
+            waiter = self.next_waiter()
+            if waiter is None:
+                return
+            queue, user_id, waiters = waiter
+            future, tokens = waiters[0]
+            if not self.can_start(tokens):
+                if self.active < self.max_concurrent and self.wakeup is None:
+                    # Only the token budget is holding things up; look again once it frees up
+                    self.wakeup = asyncio.get_running_loop().call_later(self.budget_free_in(tokens), self.on_wakeup)
+                return
+            waiters.popleft()
+            self.queued -= 1
+            # Round robin: the user goes to the back of the line behind everyone else waiting
+            del queue[user_id]
+            if waiters:
+                queue[user_id] = waiters
+            future.set_result(self.start(tokens))
+
+    def on_wakeup(self):
+        self.wakeup = None
+        self.admit()
+
+    def release(self, entry, used_tokens=None):
+        self.active -= 1
+        if used_tokens is not None:
+            self.settle(entry, used_tokens)
+        self.admit()
+
+    def reject(self, reason):
+        self.rejected += 1
+        raise CompletionBusy(reason)
+
+    async def acquire(self, user_id, priority, tokens):
+        if self.queued == 0 and self.can_start(tokens):
+            self.wait_stats.record(0.0)
+            return self.start(tokens)
+        if self.queued >= self.max_queue:
+            self.reject("completion queue is full")
+        queue = self.queues[priority]
+        if len(queue.get(user_id, ())) >= self.max_per_user:
+            self.reject("too many completions queued for this user")
+        if self.budget_free_in(tokens + sum(t for q in self.queues[:priority + 1] for w in q.values() for _, t in w)) > self.max_wait:
+            self.reject("token budget exhausted")
+
+        future = asyncio.get_running_loop().create_future()
+        queue.setdefault(user_id, collections.deque()).append((future, tokens))
+        self.queued += 1
+        # With nothing running and no wakeup armed, nothing else would ever admit this waiter
+        self.admit()
+        queued_at = time.monotonic()
+        try:
+            entry = await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self.reject("timed out waiting for a completion slot")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(future.result())
+            raise
+        self.wait_stats.record(time.monotonic() - queued_at)
+        return entry
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, priority, tokens):
+        """Hold a completion slot for the duration of the block.
+
+        The block may call the yielded function with the tokens actually used so the
+        budget tracks real usage instead of the estimate.
+        """
+        entry = await self.acquire(user_id, priority, tokens)
+        used = []
+        try:
+            yield used.append
+        finally:
+            self.release(entry, used[-1] if used else None)
+
+    def summary(self):
+        return (
+            f"OpenAI scheduler: {self.active} active, {self.queued} queued, "
+            f"{self.window_tokens} tokens in the last minute, {self.rejected} rejected"
+        )
+
+completion_scheduler = CompletionScheduler(
+    max_concurrent=int(os.getenv("OPENAI_MAX_CONCURRENCY", 8)),
+    tokens_per_minute=int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 200000)),
+    max_queue=int(os.getenv("OPENAI_MAX_QUEUE", 100)),
+    max_per_user=int(os.getenv("OPENAI_MAX_QUEUED_PER_USER", 2)),
+    max_wait=float(os.getenv("OPENAI_MAX_QUEUE_WAIT", 20))
+)
+
+# Completion policy
+class CompletionPolicy:
+    """Wraps chat completion calls with a deadline, retries, a fallback model and hedging.
+
+    Transient failures (timeouts, connection errors, 429 and 5xx) are retried with jittered
+    exponential backoff while the deadline allows. Overloads (429, 503, 529) switch the
+    remaining attempts to the fallback model. A hedged call sends a duplicate request if
+    the first has not answered within `hedge_after` seconds and keeps whichever finishes
+    first; the duplicate is charged to the scheduler's token budget and skipped when the
+    budget has no room for it. Every attempt's latency is recorded per model and outcome.
+    """
+    OVERLOAD_STATUSES = {429, 503, 529}
+
+    def __init__(self, fallback_model, deadline, retries, backoff, hedge_after):
+        self.fallback_model = fallback_model
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.attempt_stats = {}
+
+    def stats(self, model, outcome):
+        key = (model, outcome)
+        if key not in self.attempt_stats:
+            self.attempt_stats[key] = LatencyStats(f"OpenAI {model} attempts ({outcome})")
+        return self.attempt_stats[key]
+
+    @staticmethod
+    def outcome(error):
+        if error is None:
+            return "ok"
+        if isinstance(error, asyncio.CancelledError):
+            return "cancelled"
+        if isinstance(error, APITimeoutError):
+            return "timeout"
+        if isinstance(error, APIConnectionError):
+            return "connection error"
+        if isinstance(error, APIStatusError):
+            return f"status {error.status_code}"
+        return "error"
+
+    @staticmethod
+    def is_transient(error):
+        if isinstance(error, APIStatusError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, (APIConnectionError, asyncio.TimeoutError))
+
+    def retry_delay(self, attempt, error):
+        if isinstance(error, APIStatusError):
+            try:
+                return float(error.response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    async def attempt(self, model, kwargs, timeout):
+        start = time.monotonic()
+        error = None
+        try:
+            return await openai_client.chat.completions.create(model=model, timeout=timeout, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.stats(model, self.outcome(error)).record(time.monotonic() - start)
+
+    @staticmethod
+    def used_tokens(task):
+        """Tokens a finished attempt used, or None if that isn't known."""
+        if not task.done() or task.cancelled():
+            return None
+        if task.exception() is not None:
+            return 0
+        usage = task.result().usage
+        return usage.total_tokens if usage else None
+
+    async def hedged(self, model, kwargs, timeout, hedge):
+        tasks = {asyncio.create_task(self.attempt(model, kwargs, timeout))}
+        started = list(tasks)
+        reservation = None
+        winner = None
+        try:
+            if hedge and self.hedge_after > 0:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+                if not done:
+                    reservation = completion_scheduler.reserve(estimate_tokens(kwargs.get("messages", ()), kwargs.get("max_tokens") or 0))
+                if reservation is not None:
+                    task = asyncio.create_task(self.attempt(model, kwargs, max(0.1, timeout - self.hedge_after)))
+                    tasks.add(task)
+                    started.append(task)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            if reservation is not None:
+                # The caller records the winner's usage; the reservation pays for the other
+                # attempt and keeps its estimate if that one was cancelled mid-flight
+                loser = next(task for task in started if task is not winner) if winner else started[1]
+                used = self.used_tokens(loser)
+                if used is not None:
+                    completion_scheduler.settle(reservation, used)
+
+    async def create(self, model, hedge=True, **kwargs):
+        """Create a chat completion. Streams are only retried until the stream opens and are never hedged."""
+        hedge = hedge and not kwargs.get("stream")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        for attempt in range(self.retries + 1):
+            remaining = deadline - loop.time()
+            try:
+                return await asyncio.wait_for(self.hedged(model, kwargs, remaining, hedge), remaining)
+            except Exception as e:
+                if not self.is_transient(e) or attempt == self.retries:
+                    raise
+                if isinstance(e, APIStatusError) and e.status_code in self.OVERLOAD_STATUSES and self.fallback_model:
+                    model = self.fallback_model
+                delay = self.retry_delay(attempt, e)
+                if loop.time() + delay >= deadline:
+                    raise
+                await asyncio.sleep(delay)
+
+completion_policy = CompletionPolicy(
+    fallback_model=os.getenv("OPENAI_FALLBACK_MODEL", "gpt-4.1-nano"),
+    deadline=float(os.getenv("OPENAI_DEADLINE", 30)),
+    retries=int(os.getenv("OPENAI_RETRIES", 2)),
+    backoff=float(os.getenv("OPENAI_BACKOFF", 0.5)),
+    hedge_after=float(os.getenv("OPENAI_HEDGE_AFTER", 8))
+)
+
+# Memory
+class MemoryManager:
+    """Keeps conversation memory within a per-tier token budget.
+
+    Completions only ever see the newest turns that fit the budget. Once the stored
+    history grows past the budget, a background worker folds the oldest turns into
+    a running summary so the stored history shrinks again.
+
+    Turns are stored in the memory log and only read when a completion or summary
+    needs them; the records cache their turn and token counts for everything else.
+    At most `max_resident` users keep their turns loaded between uses.
+    """
+    def __init__(self, free_budget, premium_budget, model, log, max_resident):
+        self.free_budget = free_budget
+        self.premium_budget = premium_budget
+        self.model = model
+        self.log = log
+        self.max_resident = max_resident
+        self.resident = collections.OrderedDict()  # user_ids with loaded turns, least recently used first
+        self.encoding = None
+        self.encoding_loaded = False
+        self.queue = asyncio.Queue()
+        self.queued = set()
+
+    def get_encoding(self):
+        """Load the tokenizer on first use; fall back to estimates if it is unavailable."""
+        if not self.encoding_loaded:
+            self.encoding_loaded = True
+            if tiktoken is not None:
+                try:
+                    self.encoding = tiktoken.encoding_for_model(self.model)
+                except Exception as e:
+                    print(f"Using estimated token counts, could not load tokenizer: {e}")
+        return self.encoding
+
+    def count_tokens(self, text):
+        encoding = self.get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text))
+        return len(text) // 4 + 1
+
+    def count_message_tokens(self, message):
+        # Every chat message carries a few tokens of framing on top of its content.
+        return self.count_tokens(message["content"]) + 4
+
+    def count_turn_tokens(self, turn):
+        return self.count_tokens(turn.content) + 4
+
+    def budget(self, user_data):
+        return self.premium_budget if user_data.premium else self.free_budget
+
+    def memory_tokens(self, user_data):
+        return user_data.memory_tokens
+
+    async def load(self, user_id, user_data):
+        """Return a user's turns, reading them from the memory log if they aren't loaded."""
+        if user_data.memory is None:
+            user_data.memory = await self.log.load(user_id)
+            # The log wins if a crash left the cached counts behind it
+            user_data.memory_count = len(user_data.memory)
+            user_data.memory_tokens = sum(self.count_turn_tokens(turn) for turn in user_data.memory)
+        self.keep_resident(user_id)
+        return user_data.memory
+
+    async def append(self, user_id, user_data, turns):
+        """Append turns to a user's log without loading the ones already there."""
+        await self.log.append(user_id, turns)
+        if user_data.memory is not None:
+            user_data.memory.extend(turns)
+        user_data.memory_count += len(turns)
+        user_data.memory_tokens += sum(self.count_turn_tokens(turn) for turn in turns)
+
+    async def replace(self, user_id, user_data, turns):
+        """Rewrite a user's log with the given turns."""
+        await self.log.replace(user_id, turns)
+        user_data.memory = list(turns)
+        user_data.memory_count = len(turns)
+        user_data.memory_tokens = sum(self.count_turn_tokens(turn) for turn in turns)
+        self.keep_resident(user_id)
+
+    def keep_resident(self, user_id):
+        """Mark a user's turns as recently used and unload the least recently used ones."""
+        self.resident[user_id] = None
+        self.resident.move_to_end(user_id)
+        users = user_store.load()["users"]
+        while len(self.resident) > self.max_resident:
+            user_data = users.get(self.resident.popitem(last=False)[0])
+            if user_data is not None:
+                user_data.memory = None
+
+    async def migrate(self):
+        """Move histories that older versions stored with the user records into the memory log."""
+        users = user_store.load()["users"]
+        # Taken up front because locking a shared user replaces the record with the shared copy
+        legacy = {user_id: user_data.memory for user_id, user_data in users.items() if user_data.memory is not None}
+        for user_id, turns in legacy.items():
+            async with user_store.lock(user_id):
+                user_data = users.get(user_id)
+                if user_data is None:
+                    continue
+                logged = await self.log.load(user_id)
+                # A log starting with these turns comes from a migration whose record was never
+                # rewritten; anything else in the log is newer than the turns in the record
+                if logged[:len(turns)] != turns:
+                    logged = turns + logged
+                await self.replace(user_id, user_data, logged)
+                user_store.mark_dirty(user_id)
+        if legacy:
+            await user_store.flush()
+            print(f"Moved the conversation history of {len(legacy)} users to the memory log")
+
+    def build_messages(self, system_message, user_data, turns, prompt):
+        """Build the completion messages, keeping only the newest turns that fit the budget."""
+        messages = [{"role": "system", "content": system_message}]
+        if user_data.summary:
+            messages.append({"role": "system", "content": f"Summary of your earlier conversation with the user: {user_data.summary}"})
+
+        remaining = self.budget(user_data) - self.count_tokens(prompt)
+        history = []
+        for turn in reversed(turns):
+            remaining -= self.count_turn_tokens(turn)
+            if remaining < 0:
+                break
+            history.append({"role": turn.role, "content": turn.content})
+        messages.extend(reversed(history))
+
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def schedule(self, user_id, user_data):
+        """Queue a user for summarization if their stored memory is over budget."""
+        if user_id in self.queued or self.memory_tokens(user_data) <= self.budget(user_data):
+            return
+        self.queued.add(user_id)
+        self.queue.put_nowait(user_id)
+
+    async def run(self):
+        while True:
+            user_id = await self.queue.get()
+            try:
+                await self.summarize(user_id)
+            except Exception as e:
+                print(f"An error occurred while summarizing memory for {user_id}: {e}")
+            finally:
+                self.queued.discard(user_id)
+
+    async def summarize(self, user_id):
+        """Fold the oldest turns into the stored summary until memory is at half its budget."""
+        async with user_store.lock(user_id):
+            user_data = load_data()["users"].get(user_id)
+            if user_data is None:
+                return
+            turns = await self.load(user_id, user_data)
+            target = self.budget(user_data) // 2
+            tokens = self.memory_tokens(user_data)
+            old_turns = []
+            for turn in turns:
+                if tokens <= target:
+                    break
+                old_turns.append(turn)
+                tokens -= self.count_turn_tokens(turn)
+            # Never split an exchange between the summary and the remaining history
+            if len(old_turns) % 2:
+                old_turns.pop()
+            if not old_turns:
+                return
+            summary = user_data.summary
+
+        transcript = "\n".join(f"{turn.role}: {turn.content}" for turn in old_turns)
+        messages = [
+            {"role": "system", "content": "Summarize this conversation between a user and their companion Aiko in under 200 words. Keep names, facts about the user, promises and the emotional tone. Merge it with the existing summary if there is one."},
+            {"role": "user", "content": f"Existing summary: {summary or 'None'}\n\nConversation:\n{transcript}"}
+        ]
+        estimate = sum(self.count_message_tokens(message) for message in messages) + 300
+        async with completion_scheduler.slot(user_id, CompletionScheduler.BACKGROUND, estimate) as record_usage:
+            response = await completion_policy.create(
+                model=self.model,
+                hedge=False,
+                messages=messages,
+                temperature=0.3,
+                max_tokens=300
+            )
+            if response.usage:
+                record_usage(response.usage.total_tokens)
+        new_summary = response.choices[0].message.content.strip()
+
+        async with user_store.transaction(user_id) as user_data:
+            memory = await self.load(user_id, user_data)
+            # The history may have been cleared while the summary was being written
+            if len(memory) < len(old_turns) or any(a != b for a, b in zip(memory, old_turns)):
+                return
+            user_data.summary = new_summary
+            await self.replace(user_id, user_data, memory[len(old_turns):])
+
+memory_manager = MemoryManager(
+    free_budget=int(os.getenv("MEMORY_TOKEN_BUDGET_FREE", 1500)),
+    premium_budget=int(os.getenv("MEMORY_TOKEN_BUDGET_PREMIUM", 6000)),
+    model=os.getenv("MEMORY_SUMMARY_MODEL", "gpt-4o-mini"),
+    log=memory_log,
+    max_resident=int(os.getenv("MEMORY_RESIDENT_USERS", 1000))
+)
+
 # AI
-async def generate_text(prompt, user_id):
-    try:
-        data = load_data()
-        user_data = create_user(data, user_id)
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+first_visible_latency = LatencyStats("Time to first visible reply")
+BUSY_REPLY = "I’m getting a lot of messages right now, so give me a minute and try again! 🥺"
+
+class PromptCacheStats:
+    """Tracks how many prompt tokens the provider served from its prompt cache."""
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        metric_reports.append(self.summary)
+
+    def record(self, usage):
+        """Count a response's prompt tokens. Never raises, so metrics can't fail a reply."""
+        if usage is None:
+            return
+        try:
+            # openai releases that don't model prompt_tokens_details keep it as a plain dict
+            details = getattr(usage, "prompt_tokens_details", None)
+            if isinstance(details, dict):
+                cached = details.get("cached_tokens")
+            else:
+                cached = getattr(details, "cached_tokens", 0)
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.cached_tokens += cached or 0
+        except Exception as e:
+            print(f"Could not record prompt cache usage: {e!r}")
+
+    def summary(self):
+        if not self.prompt_tokens:
+            return None
+        return f"Prompt cache: {self.cached_tokens / self.prompt_tokens:.1%} of {self.prompt_tokens} prompt tokens cached"
+
+prompt_cache_stats = PromptCacheStats()
+
+class ResponseCache:
+    """Reuses replies to short, history-free messages like "hi" or "good morning".
+
+    Only greetings, farewells and emoji-only messages are cached, since a reply to
+    anything else ("yes", "why did you say that?") depends on the conversation. Keys
+    combine the normalized message with the dere type and bond level. Each key
+    collects up to `variants` replies before it starts serving them, so repeated
+    greetings still vary. Entries expire after `ttl` seconds and the least recently
+    used keys are evicted beyond `max_size`.
+    """
+    MENTION = re.compile(r"<@!?\d+>")
+    CUSTOM_EMOJI = re.compile(r"<a?:\w+:\d+>")
+    PUNCTUATION = re.compile(r"[.,!?~]+")
+    GREETING = re.compile(
+        r"(?:hi+|hey+|hello+|helo|hiya|heya|hai|yo+|sup|howdy|what'?s up|wa+s+up|"
+        r"(?:good ?)?(?:morning|afternoon|evening|night)|gm|gn|bye+|good ?bye|see (?:you|ya)|"
+        r"o?hayo+|konnichiwa|konbanwa|oyasumi)"
+        r"(?: (?:aiko|aiko-chan|chan|there|again|everyone))*"
+    )
+
+    def __init__(self, enabled, max_length, max_size, ttl, variants):
+        self.enabled = enabled
+        self.max_length = max_length
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = variants
+        self.entries = collections.OrderedDict()  # key -> (expires_at, [replies])
+        self.hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+        self.miss_tokens = 0
+        metric_reports.append(self.summary)
+
+    def normalize(self, text):
+        """The normalized text of a greeting or emoji-only message, or None for anything else."""
+        text = " ".join(self.PUNCTUATION.sub(" ", self.MENTION.sub(" ", text).casefold()).split())
+        if not text or len(text) > self.max_length:
+            return None
+        # Unicode emoji are the only non-ASCII characters that are neither letters nor digits
+        words = "".join(" " if not char.isascii() and not char.isalnum() else char for char in self.CUSTOM_EMOJI.sub(" ", text))
+        words = " ".join(words.split())
+        if words and not self.GREETING.fullmatch(words):
+            return None
+        return text
+
+    def key(self, prompt, dere_type, bond_level):
+        """The cache key for a message, or None if it should not be cached."""
+        if not self.enabled:
+            return None
+        text = self.normalize(prompt)
+        return None if text is None else (text, dere_type, bond_level)
+
+    def get(self, key):
+        if key is None:
+            return None
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self.entries[key]
+            entry = None
+        if entry is None or len(entry[1]) < self.variants:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return random.choice(entry[1])
+
+    def put(self, key, reply, seconds, tokens):
+        if key is None or not reply:
+            return
+        self.miss_seconds += seconds
+        self.miss_tokens += tokens
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = (time.monotonic() + self.ttl, [])
+        if len(entry[1]) < self.variants and reply not in entry[1]:
+            entry[1].append(reply)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return None
+        # Every hit saves roughly what an average miss cost
+        saved_seconds = self.hits * self.miss_seconds / max(self.misses, 1)
+        saved_tokens = self.hits * self.miss_tokens // max(self.misses, 1)
+        return (
+            f"Response cache: {self.hits / lookups:.1%} hit rate ({self.hits}/{lookups}), "
+            f"~{saved_seconds:.0f}s of completion latency and ~{saved_tokens} tokens saved"
+        )
+
+response_cache = ResponseCache(
+    enabled=os.getenv("RESPONSE_CACHE", "false").lower() == "true",
+    max_length=int(os.getenv("RESPONSE_CACHE_MAX_LENGTH", 32)),
+    max_size=int(os.getenv("RESPONSE_CACHE_SIZE", 1000)),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", 6 * 3600)),
+    variants=int(os.getenv("RESPONSE_CACHE_VARIANTS", 5))
+)
 
+async def build_messages(prompt, user_id):
+    """Return the completion messages, the scheduler priority and the response cache key.
+
+    Messages that can be answered from the response cache are built without history.
+    """
+    async with user_store.transaction(user_id) as user_data:
         # Determine bond level and dere type
-        bond_level = get_bond_level(user_data["bond"])
-        dere_type = user_data["style"] if user_data["style"] else "Default"  # Now always a string
+        bond_level = get_bond_level(user_data.bond)
+        dere_type = user_data.style_name
 
-        # Get the personality-based prompt
-        personality_prompt = DERE_TYPES.get(dere_type, DERE_TYPES["Default"]).get(bond_level, "")
+        # The system message only depends on dere type and bond level, so it stays a stable
+        # prefix the provider can cache; the prompt itself is sent once, as the last message
+        system_message = DERE_TYPES.get(dere_type, DERE_TYPES["Default"]).get(bond_level, "")
 
-        # Construct AI prompt
-        system_message = f"{personality_prompt}\n\n{prompt}"
+        priority = CompletionScheduler.PREMIUM if user_data.premium else CompletionScheduler.FREE
+        cache_key = response_cache.key(prompt, dere_type, bond_level)
+        if cache_key is not None:
+            return [{"role": "system", "content": system_message}, {"role": "user", "content": prompt}], priority, cache_key
+        turns = await memory_manager.load(user_id, user_data)
+        return memory_manager.build_messages(system_message, user_data, turns, prompt), priority, cache_key
 
-        messages = [{"role": "system", "content": system_message}]
-        messages.extend(user_data["memory"])
-        messages.append({"role": "user", "content": prompt})
+def estimate_tokens(messages, max_tokens):
+    """Tokens a completion may use, reserved against the scheduler's budget."""
+    return sum(memory_manager.count_message_tokens(message) for message in messages) + max_tokens
+
+async def remember_exchange(prompt, ai_response, user_id):
+    async with user_store.transaction(user_id) as user_data:
+        await memory_manager.append(user_id, user_data, [make_turn(USER, prompt), make_turn(ASSISTANT, ai_response)])
+        memory_manager.schedule(user_id, user_data)
+
+async def generate_text(prompt, user_id):
+    try:
+        # The user is not locked during the API call so commands stay responsive
+        messages, priority, cache_key = await build_messages(prompt, user_id)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            await remember_exchange(prompt, cached, user_id)
+            return cached
 
         # Call OpenAI API
-        response = await openai_client.chat.completions.create(
+        started = time.monotonic()
+        async with completion_scheduler.slot(user_id, priority, estimate_tokens(messages, 256)) as record_usage:
+            response = await completion_policy.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=1,
+                max_tokens=256,
+                top_p=1,
+                frequency_penalty=0,
+                presence_penalty=0
+            )
+            if response.usage:
+                record_usage(response.usage.total_tokens)
+                prompt_cache_stats.record(response.usage)
+
+        ai_response = response.choices[0].message.content.strip()
+        response_cache.put(cache_key, ai_response, time.monotonic() - started, response.usage.total_tokens if response.usage else 0)
+
+        # Store memory
+        await remember_exchange(prompt, ai_response, user_id)
+
+        return ai_response
+
+    except CompletionBusy:
+        return BUSY_REPLY
+    except Exception as e:
+        print(f"An error occurred in generate_text: {e}")
+        return "Oh no, can you send that message again? 🥲"
+
+async def generate_text_stream(prompt, user_id):
+    """Yield the reply as it grows. Memory is only updated once the stream completes."""
+    messages, priority, cache_key = await build_messages(prompt, user_id)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        await remember_exchange(prompt, cached, user_id)
+        return
+
+    started = time.monotonic()
+    tokens = 0
+    async with completion_scheduler.slot(user_id, priority, estimate_tokens(messages, 256)) as record_usage:
+        stream = await completion_policy.create(
             model="gpt-4o-mini",
             messages=messages,
             temperature=1,
             max_tokens=256,
             top_p=1,
             frequency_penalty=0,
-            presence_penalty=0
+            presence_penalty=0,
+            stream=True,
+            stream_options={"include_usage": True}
         )
 
-        ai_response = response.choices[0].message.content.strip()
+        ai_response = ""
+        async for chunk in stream:
+            # The final chunk carries the usage and no choices
+            if getattr(chunk, "usage", None):
+                tokens = chunk.usage.total_tokens
+                record_usage(tokens)
+                prompt_cache_stats.record(chunk.usage)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            ai_response += chunk.choices[0].delta.content
+            if ai_response.strip():
+                yield ai_response.strip()
+
+    response_cache.put(cache_key, ai_response.strip(), time.monotonic() - started, tokens)
+    await remember_exchange(prompt, ai_response.strip(), user_id)
+
+async def respond_streaming(message, prompt, user_id, received_at):
+    """Post the first chunk of a reply as soon as it arrives and edit it as more text streams in."""
+    mention = message.author.mention
+    response_message = None
+    shown = None
+    last_edit = 0
+    ai_response = None
 
-        # Store memory
-        user_data["memory"].append({"role": "user", "content": prompt})
-        user_data["memory"].append({"role": "assistant", "content": ai_response})
-        save_data(data)
+    try:
+        # Closing the stream promptly releases its completion slot if Discord fails mid-reply
+        async with contextlib.aclosing(generate_text_stream(prompt, user_id)) as stream:
+            async for ai_response in stream:
+                now = time.monotonic()
+                if response_message is None:
+                    response_message = await message.respond(f"{mention} {ai_response}")
+                    reference_resolver.remember(response_message.id)
+                    first_visible_latency.record(time.monotonic() - received_at)
+                    shown, last_edit = ai_response, now
+                elif now - last_edit >= STREAM_EDIT_INTERVAL:
+                    await response_message.edit(f"{mention} {ai_response}")
+                    shown, last_edit = ai_response, now
+    except hikari.errors.ForbiddenError:
+        return
+    except CompletionBusy:
+        ai_response = BUSY_REPLY
+    except Exception as e:
+        print(f"An error occurred in generate_text_stream: {e}")
+        ai_response = "Oh no, can you send that message again? 🥲"
 
-        return ai_response
+    try:
+        if response_message is None:
+            sent = await message.respond(f"{mention} {ai_response or 'Oh no, can you send that message again? 🥲'}")
+            reference_resolver.remember(sent.id)
+            first_visible_latency.record(time.monotonic() - received_at)
+        elif ai_response != shown:
+            await response_message.edit(f"{mention} {ai_response}")
+    except hikari.errors.ForbiddenError:
+        pass
+
+# User profiles
+class UserProfileCache:
+    """Remembers usernames and avatars for a while so /top rarely needs to fetch users.
+
+    Filled from message authors and the gateway cache; anything still missing is
+    fetched concurrently, with at most `concurrency` requests in flight.
+    """
+    def __init__(self, ttl, max_size, concurrency):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.entries = collections.OrderedDict()  # user_id -> (expires_at, username, avatar_url)
+
+    def remember(self, user):
+        self.put(int(user.id), user.username, user.avatar_url)
+
+    def put(self, user_id, username, avatar_url):
+        self.entries[user_id] = (time.monotonic() + self.ttl, username, avatar_url)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry
+
+    async def resolve(self, user_ids):
+        """Return {user_id: (username, avatar_url)}; unknown users get a None username."""
+        missing = []
+        for user_id in user_ids:
+            if self.get(user_id) is not None:
+                continue
+            cached_user = bot.cache.get_user(user_id)
+            if cached_user is not None:
+                self.remember(cached_user)
+            else:
+                missing.append(user_id)
+
+        await asyncio.gather(*(self.fetch(user_id) for user_id in set(missing)))
+        profiles = {}
+        for user_id in user_ids:
+            entry = self.get(user_id) or (None, None, None)
+            profiles[user_id] = entry[1:]
+        return profiles
+
+    async def fetch(self, user_id):
+        async with self.semaphore:
+            try:
+                self.remember(await bot.rest.fetch_user(user_id))
+            except hikari.errors.NotFoundError:
+                self.put(user_id, None, None)
+            except Exception as e:
+                print(f"An error occurred while fetching user {user_id}: {e}")
+
+user_profiles = UserProfileCache(
+    ttl=float(os.getenv("USER_PROFILE_TTL", 3600)),
+    max_size=int(os.getenv("USER_PROFILE_CACHE_SIZE", 10000)),
+    concurrency=int(os.getenv("USER_PROFILE_CONCURRENCY", 5))
+)
+
+# Message references
+class ReferenceResolver:
+    """Works out whether a reply points at one of Aiko's messages with as few REST calls as possible.
+
+    Checks the event payload, then the gateway cache, then the IDs of messages Aiko sent
+    recently. Only if none of those can answer is the message fetched, and concurrent
+    fetches of the same message share one request.
+    """
+    def __init__(self, max_recent=5000):
+        self.max_recent = max_recent
+        self.bot_messages = collections.OrderedDict()  # IDs of messages Aiko sent, oldest first
+        # Every message Aiko sent after this moment is in bot_messages
+        self.complete_since = datetime.datetime.now(datetime.timezone.utc)
+        self.fetched = collections.OrderedDict()  # message_id -> whether Aiko wrote it
+        self.inflight = {}
+
+    def remember(self, message_id):
+        """Record a message sent by Aiko."""
+        self.bot_messages[message_id] = None
+        self.bot_messages.move_to_end(message_id)
+        while len(self.bot_messages) > self.max_recent:
+            evicted, _ = self.bot_messages.popitem(last=False)
+            self.complete_since = max(self.complete_since, evicted.created_at)
+
+    async def is_reference_to_bot(self, message, bot_id):
+        reference = message.message_reference
+        if reference is None or not reference.id:
+            return False
+        message_id = reference.id
 
-    except Exception as e:
-        print(f"An error occurred in generate_text: {e}")
-        return "Oh no, can you send that message again? 🥲"
+        referenced = message.referenced_message
+        if referenced and referenced.author:
+            return referenced.author.id == bot_id
+
+        cached = bot.cache.get_message(message_id)
+        if cached is not None:
+            return cached.author.id == bot_id
+
+        if message_id in self.bot_messages:
+            return True
+        if message_id.created_at >= self.complete_since:
+            return False
+        if message_id in self.fetched:
+            return self.fetched[message_id]
+
+        author_id = await self.fetch_author_id(reference.channel_id or message.channel_id, message_id)
+        is_bot = author_id == bot_id
+        self.fetched[message_id] = is_bot
+        if len(self.fetched) > self.max_recent:
+            self.fetched.popitem(last=False)
+        return is_bot
+
+    async def fetch_author_id(self, channel_id, message_id):
+        future = self.inflight.get(message_id)
+        if future is None:
+            future = asyncio.ensure_future(self.fetch(channel_id, message_id))
+            self.inflight[message_id] = future
+            future.add_done_callback(lambda _: self.inflight.pop(message_id, None))
+        return await asyncio.shield(future)
+
+    async def fetch(self, channel_id, message_id):
+        try:
+            referenced_message = await bot.rest.fetch_message(channel_id, message_id)
+            return referenced_message.author.id
+        except (hikari.errors.ForbiddenError, hikari.errors.NotFoundError, hikari.errors.BadRequestError):
+            return None
+
+reference_resolver = ReferenceResolver()
+
+# DM rate limiting
+class RateLimiter:
+    """Allows `limit` events per `period` seconds for each key, refilling continuously.
+
+    This is a token bucket in its single-number form (GCRA): a key only stores the
+    time at which its bucket will be full again, so checks are O(1) and a key whose
+    bucket has refilled holds no information and is swept. With a path set, the
+    state is saved there periodically and on shutdown so limits survive restarts.
+    """
+    def __init__(self, limit, period, path=None, sweep_interval=600):
+        self.interval = period / limit
+        self.period = period
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.full_at = {}  # key -> time.time() at which the bucket is full again
+
+    def allow(self, key, now=None):
+        """Take a token for `key` if one is left."""
+        now = now or time.time()
+        full_at = max(self.full_at.get(key, now), now) + self.interval
+        if full_at - now > self.period:
+            return False
+        self.full_at[key] = full_at
+        return True
+
+    def retry_after(self, key, now=None):
+        """Seconds until `key` gets a token back."""
+        now = now or time.time()
+        return max(0.0, self.full_at.get(key, now) + self.interval - self.period - now)
+
+    def sweep(self, now=None):
+        now = now or time.time()
+        self.full_at = {key: full_at for key, full_at in self.full_at.items() if full_at > now}
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as file:
+                self.full_at = json_loads(file.read())
+        except ValueError as e:
+            print(f"Starting with empty rate limits, could not read {self.path}: {e}")
+        self.sweep()
+
+    async def save(self):
+        if self.path:
+            await asyncio.to_thread(write_data_file, self.path, json_dumps(self.full_at))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+            try:
+                await self.save()
+            except Exception as e:
+                print(f"An error occurred while saving rate limits: {e}")
+
+# DMs are only delivered to shard 0, so one process sees every DM and a local limiter is exact
+dm_limiter = RateLimiter(
+    limit=int(os.getenv("DM_LIMIT", 30)),
+    period=float(os.getenv("DM_LIMIT_PERIOD", 3600)),
+    path=os.getenv("DM_LIMIT_FILE")
+)
+dm_limiter.load()
 
 # AI response message event listener
-@bot.listen(hikari.MessageCreateEvent)
+@message_router.route(may_address_aiko)
 async def on_ai_message(event: hikari.MessageCreateEvent):
-    if event.message.author.is_bot:
-        return
-
+    received_at = time.monotonic()
     user_id = str(event.message.author.id)
-    data = load_data()
+    user_profiles.remember(event.message.author)
     content = event.message.content or ""
-
-    guild_id = str(event.guild_id) if hasattr(event, 'guild_id') else None
-    is_dm = guild_id is None
+    direct_message = is_dm(event)
 
     channel_id = str(event.channel_id)
     current_time = time.time()
     bot_id = bot.get_me().id
     bot_mention = f"<@{bot_id}>"
     mentions_bot = bot_mention in content
-    references_message = event.message.message_reference is not None
+    is_reference_to_bot = not (mentions_bot or direct_message) and await reference_resolver.is_reference_to_bot(event.message, bot_id)
 
-    if references_message:
-        try:
-            referenced_message = await bot.rest.fetch_message(event.channel_id, event.message.message_reference.id)
-            is_reference_to_bot = referenced_message.author.id == bot_id
-        except (hikari.errors.ForbiddenError, hikari.errors.NotFoundError, hikari.errors.BadRequestError):
-            is_reference_to_bot = False
-    else:
-        is_reference_to_bot = False
+    if mentions_bot or is_reference_to_bot or direct_message:
+        # Decided in memory before any storage or OpenAI work; premium and votes are
+        # only looked up for a user who is over the limit
+        over_limit = direct_message and not dm_limiter.allow(user_id)
 
-    if mentions_bot or is_reference_to_bot or is_dm:
-        user_data = create_user(data, user_id)
-        is_premium = user_data["premium"]
+        async with user_store.transaction(user_id) as user_data:
+            is_premium = user_data.premium
 
-        last_interaction = user_data.get("last_interaction")
+            last_interaction = user_data.last_interaction
 
-        if last_interaction:
-            last_date = datetime.datetime.fromtimestamp(last_interaction, tz=datetime.timezone.utc).date()
-            current_date = datetime.datetime.fromtimestamp(current_time, tz=datetime.timezone.utc).date()
+            if last_interaction:
+                last_date = datetime.datetime.fromtimestamp(last_interaction, tz=datetime.timezone.utc).date()
+                current_date = datetime.datetime.fromtimestamp(current_time, tz=datetime.timezone.utc).date()
 
-            if current_date > last_date:
-                user_data["streak"] += 1
-                points_to_add = 10 + (10 * user_data["streak"])
-                if is_premium:
-                    points_to_add *= 2
-                user_data["points"] += points_to_add
-
-        user_data["last_interaction"] = current_time
-        save_data(data)
+                if current_date > last_date:
+                    user_data.streak += 1
+                    points_to_add = 10 + (10 * user_data.streak)
+                    if is_premium:
+                        points_to_add *= 2
+                    user_data.points += points_to_add
 
-        if is_dm and not is_premium:
-            reset_time = user_reset_time.get(user_id, 0)
+            user_data.last_interaction = current_time
 
-            if current_time - reset_time > 3600:
-                user_response_count[user_id] = 0
-                user_reset_time[user_id] = current_time
+        if over_limit and not is_premium:
+            has_voted = await topgg_client.get_user_vote(user_id)
+            if not has_voted:
+                minutes = max(1, round(dm_limiter.retry_after(user_id) / 60))
+                await event.message.respond(f"Oh no! 🥺 We’ve reached the limit of messages I can send in DMs, but I can reply again in about {minutes} minute{'s' if minutes != 1 else ''}. If you would like to continue without waiting, you can either vote on [top.gg](https://top.gg/bot/1285298352308621416/vote) for free or become a [supporter](https://ko-fi.com/aza3l/tiers)! Thank you! 💖")
+                return
             else:
-                if user_id not in user_response_count:
-                    user_response_count[user_id] = 0
-                    user_reset_time[user_id] = current_time
-
-            if user_response_count.get(user_id, 0) >= 30:
-                has_voted = await topgg_client.get_user_vote(user_id)
-                if not has_voted:
-                    await event.message.respond("Oh no! 🥺 We’ve reached the limit of messages I can send in DMs, but this will reset in an hour. If you would like to continue without waiting, you can either vote on [top.gg](https://top.gg/bot/1285298352308621416/vote) for free or become a [supporter](https://ko-fi.com/aza3l/tiers)! Thank you! 💖")
-                    user_limit_reached[user_id] = current_time
-                    return
-                else:
-                    user_data["points"] += 50
+                async with user_store.transaction(user_id) as user_data:
+                    user_data.points += 50
                     if is_premium:
-                        user_data["points"] += 50
-                    user_data["bond"] = min(100, user_data["bond"] + 2)
-                    save_data(data)
+                        user_data.points += 50
+                    user_data.bond = min(100, user_data.bond + 2)
+
+        if STREAM_RESPONSES:
+            await respond_streaming(event.message, content, user_id, received_at)
+            return
 
         async with bot.rest.trigger_typing(channel_id):
             ai_response = await generate_text(content, user_id)
 
-        user_response_count[user_id] = user_response_count.get(user_id, 0) + 1
         response_message = f"{event.message.author.mention} {ai_response}"
 
         try:
-            await event.message.respond(response_message)
+            sent = await event.message.respond(response_message)
+            reference_resolver.remember(sent.id)
+            first_visible_latency.record(time.monotonic() - received_at)
         except hikari.errors.ForbiddenError:
             pass
 
 # Daily checks
+def apply_daily_decay(user_data, today=None):
+    """Apply the bond decay and streak reset of every UTC midnight since the record was last settled.
+
+    Each midnight, a user who last interacted `days_since` days ago loses 5 * days_since
+    bond, and their streak is moved to previous_streak once days_since exceeds 1.
+    Returns True if anything changed.
+    """
+    today = today or datetime.datetime.now(datetime.timezone.utc).date().toordinal()
+    settled = user_data.decayed_through
+    user_data.decayed_through = today
+    # Records from before lazy decay were settled by the old midnight job
+    if settled is None or settled >= today or not user_data.last_interaction:
+        return settled != today
+
+    last_day = utc_day(user_data.last_interaction)
+
+    first = max(settled + 1, last_day + 1)
+    if first <= today:
+        nights = today - first + 1
+        decay = 5 * (first - last_day + today - last_day) * nights // 2
+        user_data.bond = max(0, user_data.bond - decay)
+
+    # Only the last two resets matter: after two, both streaks are zero
+    resets = today - max(settled + 1, last_day + 2) + 1
+    for _ in range(min(max(resets, 0), 2)):
+        user_data.previous_streak = user_data.streak
+        user_data.streak = 0
+    return True
+
 async def daily_maintenance():
+    """Settle only the users whose streak lapses at each UTC midnight; everything else decays lazily."""
     while True:
         now = datetime.datetime.now(datetime.timezone.utc)
         next_reset = now.replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
         await asyncio.sleep((next_reset - now).total_seconds())
 
-        data = load_data()
-        current_time = time.time()
-        current_date = datetime.datetime.fromtimestamp(current_time, tz=datetime.timezone.utc).date()
-
-        for user_id, user_data in data["users"].items():
-            if user_data["last_interaction"]:
-                last_date = datetime.datetime.fromtimestamp(
-                    user_data["last_interaction"], tz=datetime.timezone.utc
-                ).date()
-                days_since = (current_date - last_date).days
-
-                if days_since > 0:
-                    user_data["bond"] = max(0, user_data["bond"] - 5 * days_since)
-
-                    if days_since > 1:
-                        user_data["previous_streak"] = user_data.get("streak", 0)
-                        user_data["streak"] = 0
-
-        save_data(data)
+        today = datetime.datetime.now(datetime.timezone.utc).date().toordinal()
+        for user_id in user_store.activity.users_on(today - 2):
+            async with user_store.lock(user_id):
+                data = load_data()
+                user_data = data["users"].get(user_id)
+                if user_data is not None and apply_daily_decay(user_data, today):
+                    save_data(data, user_id)
 
 def get_bond_level(bond):
     """Determine bond level based on bond percentage (0-100)."""
@@ -487,30 +3035,102 @@ def get_bond_level(bond):
     else:
         return 6  # Soulmate
 
-async def check_vote_expiration():
-    while True:
+# Expiry scheduling
+class ExpiryScheduler:
+    """Min-heap of deadlines that sleeps until the earliest one and then calls handler(key).
+
+    Scheduling a key again replaces its previous deadline; the old heap entry is
+    skipped when it surfaces. Usable for anything keyed by an expiry time, such as
+    votes, rate-limit windows or premium periods.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.heap = []
+        self.deadlines = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.running = False
+
+    def schedule(self, key, expires_at):
+        if self.deadlines.get(key) == expires_at:
+            return
+        self.deadlines[key] = expires_at
+        # Until run() starts (on the leader) only the deadlines are kept
+        if self.running:
+            heapq.heappush(self.heap, (expires_at, next(self.counter), key))
+            if self.heap[0][2] == key:
+                self.wakeup.set()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    async def run(self):
+        self.heap = [(expires_at, next(self.counter), key) for key, expires_at in self.deadlines.items()]
+        heapq.heapify(self.heap)
+        self.running = True
+        try:
+            await self.process()
+        finally:
+            self.running = False
+
+    async def process(self):
+        while True:
+            while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            try:
+                await self.handler(key)
+            except Exception as e:
+                print(f"An error occurred while handling expiry of {key}: {e}")
+
+async def expire_vote(user_id):
+    async with user_store.lock(user_id):
         data = load_data()
-        current_time = time.time()
-        next_check_time = float('inf')  # Track when we should next wake up
-
-        for user_id, user_data in data["users"].items():
-            if user_data.get("last_voted_at"):
-                last_voted_time = datetime.datetime.strptime(user_data["last_voted_at"], "%Y-%m-%d %H:%M:%S")
-                time_since_vote = datetime.datetime.now() - last_voted_time
-                
-                if time_since_vote > datetime.timedelta(hours=12):  # Vote expired
-                    user_data["point_received"] = False
-                    user_data["last_voted_at"] = None  # Reset vote time
-                else:
-                    # Calculate remaining time until expiration
-                    remaining_time = (datetime.timedelta(hours=12) - time_since_vote).total_seconds()
-                    next_check_time = min(next_check_time, remaining_time)
+        user_data = data["users"].get(user_id)
+        if user_data is None or not user_data.last_voted_at:
+            return
+        expires_at = user_data.last_voted_at + VOTE_WINDOW
+        if expires_at > time.time():
+            vote_expiry.schedule(user_id, expires_at)
+            return
+        user_data.point_received = False
+        user_data.last_voted_at = None  # Reset vote time
+        save_data(data, user_id)
 
-        save_data(data)
+vote_expiry = ExpiryScheduler(expire_vote)
 
-        # If there are users with active votes, sleep until the nearest expiration
-        sleep_time = max(60, next_check_time)  # Ensure a minimum check every minute
-        await asyncio.sleep(sleep_time)
+def schedule_vote_expiry(user_id, user_data):
+    """Follow votes recorded by other workers."""
+    if user_data is not None and isinstance(user_data.last_voted_at, (int, float)):
+        vote_expiry.schedule(user_id, user_data.last_voted_at + VOTE_WINDOW)
+
+user_store.listeners.append(schedule_vote_expiry)
+
+async def check_vote_expiration():
+    """Schedule every active vote once at startup, then expire each one exactly when it runs out."""
+    users = load_data()["users"]
+    old_format = [user_id for user_id, user_data in users.items() if user_data.last_voted_at and not isinstance(user_data.last_voted_at, (int, float))]
+    for user_id in old_format:
+        async with user_store.lock(user_id):
+            user_data = users.get(user_id)
+            if user_data is not None and user_data.last_voted_at and not isinstance(user_data.last_voted_at, (int, float)):
+                user_data.last_voted_at = vote_timestamp(user_data.last_voted_at)
+                user_store.mark_dirty(user_id)
+    for user_id, user_data in users.items():
+        if user_data.last_voted_at:
+            vote_expiry.schedule(user_id, user_data.last_voted_at + VOTE_WINDOW)
+    await vote_expiry.run()
 
 # Commands----------------------------------------------------------------------------------------------------------------------------------------
 
@@ -524,22 +3144,18 @@ async def dere_set(ctx: lightbulb.Context) -> None:
     user_id = str(ctx.author.id)
     selected_personality = ctx.options.personality
 
-    data = load_data()
-    user_data = create_user(data, user_id)
+    async with user_store.transaction(user_id) as user_data:
+        if selected_personality == "Default":
+            user_data.style = None  # Reset to default
+        else:
+            user_data.style = Style[selected_personality]
 
     if selected_personality == "Default":
-        user_data["style"] = None  # Reset to default
-        save_data(data)
         await ctx.respond("My personality has been reset to default. Let’s start fresh! 😊 What would you like to talk about?")
     else:
-        user_data["style"] = selected_personality
-        save_data(data)
         await ctx.respond(f'My personality has been set to: “{selected_personality}”.')
 
-    try:
-        await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-    except Exception as e:
-        print(f"{e}")
+    audit_log.command(ctx)
 
 # Memory clear command
 @bot.command()
@@ -548,56 +3164,53 @@ async def dere_set(ctx: lightbulb.Context) -> None:
 @lightbulb.implements(lightbulb.SlashCommand)
 async def memory_clear(ctx: lightbulb.Context):
     user_id = str(ctx.author.id)
-    data = load_data()
-    user_data = create_user(data, user_id)
+    async with user_store.transaction(user_id) as user_data:
+        had_memory = bool(user_data.memory_count or user_data.summary)
+        if had_memory:
+            await memory_manager.replace(user_id, user_data, [])
+            user_data.summary = None
 
-    if user_data["memory"]:
-        user_data["memory"] = []
-        save_data(data)
+    if had_memory:
         await ctx.respond("Your memories with me have been cleared, but don’t worry! Let’s keep chatting and make new memories together! 😊✨")
     else:
         await ctx.respond("We haven’t had a chance to chat yet, so there aren’t any memories to clear! Let’s start our conversation and create some together! 😊💕.")
 
-    try:
-        await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-    except Exception as e:
-        print(f"{e}")
+    audit_log.command(ctx)
 
 # Leaderboard
 @bot.command()
 @lightbulb.command("top", "View the leaderboard", auto_defer=True)
 @lightbulb.implements(lightbulb.SlashCommand)
 async def leaderboard(ctx):
-    data = load_data()
+    users = load_data()["users"]
     current_user_id = str(ctx.author.id)
 
-    all_users = []
-    for user_id in data["users"]:
-        user_data = create_user(data, user_id)
-        user_data["user_id"] = user_id
-        all_users.append(user_data)
+    # Streaks shown here must include any lapse that hasn't been settled yet
+    for user_id in user_store.leaderboard.top(5) + [current_user_id]:
+        if user_id not in users:
+            continue
+        async with user_store.lock(user_id):
+            user_data = users.get(user_id)
+            if user_data is not None and apply_daily_decay(user_data):
+                user_store.mark_dirty(user_id)
 
-    sorted_users = sorted(all_users, key=lambda x: x["points"], reverse=True)
+    top_5 = [(user_id, users[user_id]) for user_id in user_store.leaderboard.top(5)]
 
-    top_5 = sorted_users[:5]
+    current_user_rank = user_store.leaderboard.rank(current_user_id)
+    current_user_data = users.get(current_user_id)
 
-    current_user_rank = next((index + 1 for index, user in enumerate(sorted_users) if user["user_id"] == current_user_id), None)
-    current_user_data = next((user for user in sorted_users if user["user_id"] == current_user_id), None)
-    current_user_username = await bot.rest.fetch_user(int(current_user_id)) if current_user_data else None
+    user_profiles.remember(ctx.author)
+    profiles = await user_profiles.resolve([int(user_id) for user_id, _ in top_5])
 
     embed = hikari.Embed(title="🏆 Leaderboard 🏆", color=0x2B2D31)
 
     top_list = []
-    for idx, user in enumerate(top_5, 1):
-        try:
-            user_obj = await bot.rest.fetch_user(int(user["user_id"]))
-            username = user_obj.username
-        except (hikari.errors.NotFoundError, KeyError):
-            username = "Unknown User"
+    for idx, (user_id, user) in enumerate(top_5, 1):
+        username = profiles[int(user_id)][0] or "Unknown User"
 
         entry = (
             f"`#{idx}` {username}\n"
-            f"Points: {user['points']} • Streak: {user['streak']}"
+            f"Points: {user.points} • Streak: {user.streak}"
         )
         top_list.append(entry)
 
@@ -609,8 +3222,8 @@ async def leaderboard(ctx):
 
     if current_user_data and current_user_rank:
         user_position = (
-            f"`#{current_user_rank}` {current_user_username.username}\n"
-            f"Points: {current_user_data['points']} • Streak: {current_user_data['streak']}"
+            f"`#{current_user_rank}` {ctx.author.username}\n"
+            f"Points: {current_user_data.points} • Streak: {current_user_data.streak}"
         )
 
         embed.add_field(
@@ -621,10 +3234,7 @@ async def leaderboard(ctx):
 
     await ctx.respond(embed=embed)
 
-    try:
-        await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-    except Exception as e:
-        print(f"{e}")
+    audit_log.command(ctx)
 
 # Gift command
 @bot.command()
@@ -634,44 +3244,40 @@ async def leaderboard(ctx):
 @lightbulb.implements(lightbulb.SlashCommand)
 async def gift(ctx: lightbulb.Context) -> None:
     user_id = str(ctx.author.id)
-    data = load_data()
-    user_data = create_user(data, user_id)
-
-    max_bond = 100
-    current_bond = user_data["bond"]
-    points_available = user_data["points"]
-
-    if ctx.options.amount is not None:
-        points_to_gift = ctx.options.amount
-    else:
-        bond_needed = max_bond - current_bond
-        points_needed = bond_needed * 5
-        points_to_gift = min(points_needed, points_available)
-
-    if points_to_gift <= 0:
-        await ctx.respond("❌ You need to gift at least **5** points (1% bond).")
-        return
-    if points_to_gift > points_available:
-        await ctx.respond(f"❌ You only have **{points_available}** points available.")
+    error = None
+
+    async with user_store.transaction(user_id) as user_data:
+        max_bond = 100
+        current_bond = user_data.bond
+        points_available = user_data.points
+
+        if ctx.options.amount is not None:
+            points_to_gift = ctx.options.amount
+        else:
+            bond_needed = max_bond - current_bond
+            points_needed = bond_needed * 5
+            points_to_gift = min(points_needed, points_available)
+
+        if points_to_gift <= 0:
+            error = "❌ You need to gift at least **5** points (1% bond)."
+        elif points_to_gift > points_available:
+            error = f"❌ You only have **{points_available}** points available."
+        else:
+            bond_increase = points_to_gift // 5
+            new_bond = min(max_bond, current_bond + bond_increase)
+
+            user_data.points -= points_to_gift
+            user_data.bond = new_bond
+
+    if error:
+        await ctx.respond(error)
         return
 
-    bond_increase = points_to_gift // 5
-    new_bond = min(max_bond, current_bond + bond_increase)
-
-    user_data["points"] -= points_to_gift
-    user_data["bond"] = new_bond
-    save_data(data)
-
     await ctx.respond(
         f"🎁 You gifted **{points_to_gift}** points! Aiko's bond increased by **{bond_increase}%** and is now at **{new_bond}%**! 💖"
     )
 
-    try:
-        await bot.rest.create_message(
-            1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`."
-        )
-    except Exception as e:
-        print(f"Error logging gift command: {e}")
+    audit_log.command(ctx)
 
 # Restore command
 @bot.command()
@@ -680,11 +3286,21 @@ async def gift(ctx: lightbulb.Context) -> None:
 @lightbulb.implements(lightbulb.SlashCommand)
 async def restore(ctx: lightbulb.Context) -> None:
     user_id = str(ctx.author.id)
-    data = load_data()
-    user_data = create_user(data, user_id)
+    restored = False
 
-    current_streak = user_data.get("streak", 0)
-    previous_streak = user_data.get("previous_streak", 0)
+    # The vote check is a network call, so it happens before the user is locked
+    user_data = load_data()["users"].get(user_id)
+    has_voted = False if user_data is not None and user_data.premium else await topgg_client.get_user_vote(user_id)
+
+    async with user_store.transaction(user_id) as user_data:
+        current_streak = user_data.streak
+        previous_streak = user_data.previous_streak
+        is_premium = user_data.premium
+
+        if current_streak == 0 and previous_streak != 0 and (is_premium or has_voted):
+            user_data.streak = previous_streak
+            user_data.previous_streak = 0
+            restored = True
 
     if current_streak > 0:
         await ctx.respond(f"🎉 You still have an active streak of **{current_streak} days**! No need to restore it! 🔥")
@@ -694,30 +3310,18 @@ async def restore(ctx: lightbulb.Context) -> None:
         await ctx.respond("😔 You don't have a previous streak to restore. Keep talking to Aiko daily to build your streak! 💖")
         return
 
-    if user_data["premium"]:
-        user_data["streak"] = previous_streak
-        user_data["previous_streak"] = 0
-        save_data(data)
+    if restored and is_premium:
         await ctx.respond(f"✅ Your streak has been restored to **{previous_streak} days**! 🔥")
         return
 
-    has_voted = await topgg_client.get_user_vote(user_id)
-    if has_voted:
-        user_data["streak"] = previous_streak
-        user_data["previous_streak"] = 0
-        save_data(data)
+    if restored:
         await ctx.respond(f"✅ Your streak has been restored to **{previous_streak} days**! 🔥")
     else:
         await ctx.respond(
             "😔 You need to vote to restore your streak. Please vote on [top.gg](https://top.gg/bot/1285298352308621416/vote) and try again! 💖"
         )
 
-    try:
-        await bot.rest.create_message(
-            1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`."
-        )
-    except Exception as e:
-        print(f"Error logging restore command: {e}")
+    audit_log.command(ctx)
 
 # Misc----------------------------------------------------------------------------------------------------------------------------------------
 
@@ -728,10 +3332,10 @@ async def restore(ctx: lightbulb.Context) -> None:
 @lightbulb.implements(lightbulb.SlashCommand)
 async def help(ctx):
     user_id = str(ctx.author.id)
-    data = load_data()
-    user_data = create_user(data, user_id)
+    async with user_store.transaction(user_id) as user_data:
+        is_premium = user_data.premium
 
-    if user_data["premium"]:
+    if is_premium:
         await ctx.command.cooldown_manager.reset_cooldown(ctx)
 
     embed = hikari.Embed(
@@ -774,10 +3378,7 @@ async def help(ctx):
     )
     await ctx.respond(embed=embed)
 
-    try:
-        await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-    except Exception as e:
-        print(f"{e}")
+    audit_log.command(ctx)
 
 # Profile command
 @bot.command()
@@ -786,33 +3387,31 @@ async def help(ctx):
 @lightbulb.implements(lightbulb.SlashCommand)
 async def profile(ctx: lightbulb.Context):
     user_id = str(ctx.author.id)
-    data = load_data()
-    user_data = create_user(data, user_id)
     has_voted = await topgg_client.get_user_vote(user_id)
 
-    if has_voted:
-        if user_data.get("last_voted_at"):
-            last_voted_time = datetime.datetime.strptime(user_data["last_voted_at"], "%Y-%m-%d %H:%M:%S")
-            if datetime.datetime.now() - last_voted_time > datetime.timedelta(hours=12):
-                user_data["point_received"] = False
-                user_data["last_voted_at"] = None
-        
-        if not user_data.get("point_received", False):
-            user_data["points"] += 50
-            if user_data["premium"]:
-                user_data["points"] += 50
-            user_data["point_received"] = True
-            user_data["last_voted_at"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            save_data(data)
-
-    dere_type = user_data["style"] if user_data["style"] else "Default"
-
-    bond_level = get_bond_level(user_data["bond"])
+    async with user_store.transaction(user_id) as user_data:
+        if has_voted:
+            last_voted_at = vote_timestamp(user_data.last_voted_at)
+            if last_voted_at and time.time() - last_voted_at > VOTE_WINDOW:
+                user_data.point_received = False
+                user_data.last_voted_at = None
+
+            if not user_data.point_received:
+                user_data.points += 50
+                if user_data.premium:
+                    user_data.points += 50
+                user_data.point_received = True
+                user_data.last_voted_at = time.time()
+                vote_expiry.schedule(user_id, user_data.last_voted_at + VOTE_WINDOW)
+
+    dere_type = user_data.style_name
+
+    bond_level = get_bond_level(user_data.bond)
     bond_description = f"Aiko's bond to you: **{BOND_LEVELS[bond_level]}** ❤️\n\nGift her to increase her bond with you and get warmer responses.\nLearn more with the `/help` command.\n\n[Vote to earn additional gift points and unlock streak restores.](https://top.gg/bot/1285298352308621416/vote)"
 
-    memory_limit = 30
-    memory_used = len(user_data["memory"]) // 2
-    memory_percentage = round((memory_used / memory_limit) * 100) if not user_data["premium"] else "Unlimited"
+    memory_limit = memory_manager.budget(user_data)
+    memory_used = memory_manager.memory_tokens(user_data)
+    memory_percentage = min(100, round((memory_used / memory_limit) * 100)) if not user_data.premium else "Unlimited"
     memory_status = f"{memory_percentage}%" if isinstance(memory_percentage, int) else "Unlimited"
 
     embed = hikari.Embed(
@@ -821,22 +3420,19 @@ async def profile(ctx: lightbulb.Context):
     )
     embed.set_author(name=f"{ctx.author.username}'s Profile", icon=ctx.author.avatar_url)
 
-    embed.add_field(name="Streak", value=f"🔥 {user_data['streak']} days", inline=True)
-    embed.add_field(name="Bond", value=f"💖 {user_data['bond']}%", inline=True)
-    embed.add_field(name="Points", value=f"🏅 {user_data['points']}", inline=True)
+    embed.add_field(name="Streak", value=f"🔥 {user_data.streak} days", inline=True)
+    embed.add_field(name="Bond", value=f"💖 {user_data.bond}%", inline=True)
+    embed.add_field(name="Points", value=f"🏅 {user_data.points}", inline=True)
     embed.add_field(name="Memory", value=f'📀 {memory_status}', inline=True)
     embed.add_field(name="Dere", value=f'🧩 {dere_type}', inline=True)
-    embed.add_field(name="Premium", value=f'{"✅ Active" if user_data["premium"] else "❌ Not Active"}', inline=True)
+    embed.add_field(name="Premium", value=f'{"✅ Active" if user_data.premium else "❌ Not Active"}', inline=True)
 
-    if user_data["premium"]:
+    if user_data.premium:
         await ctx.command.cooldown_manager.reset_cooldown(ctx)
 
     await ctx.respond(embed=embed)
 
-    try:
-        await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-    except Exception as e:
-        print(f"Error logging profile command: {e}")
+    audit_log.command(ctx)
 
 # Claim command
 @bot.command()
@@ -845,33 +3441,31 @@ async def profile(ctx: lightbulb.Context):
 @lightbulb.command("claim", "Claim premium after subscribing.")
 @lightbulb.implements(lightbulb.SlashCommand)
 async def claim(ctx: lightbulb.Context) -> None:
-    data = load_data()
     user_id = str(ctx.author.id)
-    user_data = create_user(data, user_id)
-
     email = ctx.options.email
     current_time = int(time.time())
+    claimed = False
 
-    if user_data["premium"]:
+    async with user_store.transaction(user_id) as user_data:
+        already_premium = user_data.premium
+        if not already_premium and await premium_emails.claim(email, user_id):
+            user_data.premium = True
+            user_data.email = email
+            user_data.claim_time = current_time
+            claimed = True
+
+    if claimed:
+        await user_store.flush()
+
+    if already_premium:
         await ctx.command.cooldown_manager.reset_cooldown(ctx)
         await ctx.respond("You already have premium. Thank you! ❤️")
-        try:
-            await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-        except Exception as e:
-            print(f"{e}")
+        audit_log.command(ctx)
         return
 
-    if email in prem_email:
-        user_data["premium"] = True
-        user_data["email"] = email
-        user_data["claim_time"] = current_time
-        prem_email.remove(email)
-        save_data(data)
+    if claimed:
         await ctx.respond("You have premium now! Thank you so much. ❤️")
-        try:
-            await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-        except Exception as e:
-            print(f"{e}")
+        audit_log.command(ctx)
     else:
         embed = hikari.Embed(
             title="Your email was not recognized.",
@@ -886,10 +3480,7 @@ async def claim(ctx: lightbulb.Context) -> None:
             color=0x2f3136
         )
         await ctx.respond(embed=embed)
-        try:
-            await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-        except Exception as e:
-            print(f"{e}")
+        audit_log.command(ctx)
 
 # Reset command
 @bot.command()
@@ -898,19 +3489,21 @@ async def claim(ctx: lightbulb.Context) -> None:
 @lightbulb.implements(lightbulb.SlashCommand)
 async def reset_data(ctx: lightbulb.Context) -> None:
     user_id = str(ctx.author.id)
-    data = load_data()
 
-    if user_id in data["users"]:
-        del data["users"][user_id]
-        save_data(data)
+    async with user_store.lock(user_id):
+        data = load_data()
+        existed = data["users"].pop(user_id, None) is not None
+        if existed:
+            await memory_log.replace(user_id, [])
+            save_data(data, user_id)
+
+    if existed:
+        await user_store.flush()
         await ctx.respond("🚨 Your data has been **completely reset**. You’re starting fresh! 💖")
     else:
         await ctx.respond("You don’t have any saved data to reset! 😊")
 
-    try:
-        await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-    except Exception as e:
-        print(f"Error logging reset_data command: {e}")
+    audit_log.command(ctx)
 
 # Privacy Policy Command
 @bot.command()
@@ -919,10 +3512,10 @@ async def reset_data(ctx: lightbulb.Context) -> None:
 @lightbulb.implements(lightbulb.SlashCommand)
 async def privacy(ctx: lightbulb.Context) -> None:
     user_id = str(ctx.author.id)
-    data = load_data()
-    user_data = create_user(data, user_id)
+    async with user_store.transaction(user_id) as user_data:
+        is_premium = user_data.premium
 
-    if user_data["premium"]:
+    if is_premium:
         await ctx.command.cooldown_manager.reset_cooldown(ctx)
 
     embed = hikari.Embed(
@@ -958,10 +3551,7 @@ async def privacy(ctx: lightbulb.Context) -> None:
     )
     await ctx.respond(embed=embed)
 
-    try:
-        await bot.rest.create_message(1285303262127325301, f"`{ctx.command.name}` invoked in `{ctx.get_guild().name}` by `{ctx.author.id}`.")
-    except Exception as e:
-        print(f"Error logging privacy command: {e}")
+    audit_log.command(ctx)
 
 # Error handling
 @bot.listen(lightbulb.CommandErrorEvent)
@@ -977,9 +3567,17 @@ async def on_error(event: lightbulb.CommandErrorEvent) -> None:
 	else:
 		raise exception
 
-# Top.gg stop
+# Shutdown
 @bot.listen(hikari.StoppedEvent)
 async def on_stopping(event: hikari.StoppedEvent):
-    await topgg_client.close()
-
-bot.run()
\ No newline at end of file
+    await leader.release()
+    await stop_webhooks()
+    await audit_log.close()
+    await dm_limiter.save()
+    await premium_emails.close()
+    await http_client.close()
+    await user_store.close()
+    memory_log.close()
+    await shared_state.close()
+
+bot.run(shard_ids=worker_shard_ids(SHARD_COUNT, WORKER_COUNT, WORKER_INDEX), shard_count=SHARD_COUNT)
\ No newline at end of file
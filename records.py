@@ -0,0 +1,88 @@
+"""Compact in-memory representation of a user.
+
+Resident users are UserRecord objects rather than the dicts stored in data.json:
+fields live in __slots__ instead of a per-user hash table, the dere type is a
+shared Style member instead of a per-user string, and each conversation turn is
+a Turn tuple whose role is one of two shared strings. from_json() and to_json()
+convert losslessly to and from the stored JSON schema.
+
+Conversation turns are not part of that schema: they live in the memory log and
+`memory` stays None until a user's turns are loaded. The turn and token counts
+are cached on the record so nothing else has to load them.
+"""
+import collections
+import dataclasses
+import enum
+
+Style = enum.Enum("Style", [
+    "Default", "Yandere", "Tsundere", "Kuudere", "Himedere", "Bakadere", "Sadodere", "Dorodere",
+    "Hinedere", "Kamidere", "Nyandere", "Bodere", "Erodere", "Mayadere", "Fushidere", "Hikandere"
+])
+
+USER = "user"
+ASSISTANT = "assistant"
+ROLES = {USER: USER, ASSISTANT: ASSISTANT}
+
+Turn = collections.namedtuple("Turn", ["role", "content"])
+
+def make_turn(role, content):
+    """A Turn sharing the role string with every other turn of that role."""
+    return Turn(ROLES.get(role, role), content)
+
+@dataclasses.dataclass(slots=True, eq=False)
+class UserRecord:
+    premium: bool = False
+    email: str = None
+    claim_time: int = None
+    style: Style = None  # None is the default personality
+    limit_reached: bool = False
+    points: int = 0
+    point_received: bool = False
+    last_voted_at: float = None
+    streak: int = 0
+    previous_streak: int = 0
+    last_interaction: float = None
+    bond: int = 20
+    memory: list = None  # of Turn, None until loaded from the memory log
+    memory_count: int = 0
+    memory_tokens: int = 0
+    summary: str = None
+    decayed_through: int = None
+    extra: dict = None  # keys this version doesn't know about, kept so nothing is lost
+
+    @classmethod
+    def from_json(cls, data):
+        record = cls()
+        for key, value in data.items():
+            if key == "style":
+                if value is None or value in Style.__members__:
+                    record.style = Style[value] if value is not None else None
+                else:
+                    record.set_extra(key, value)
+            elif key == "memory":
+                # Histories stored before the memory log existed, moved there on startup
+                record.memory = [make_turn(turn["role"], turn["content"]) for turn in value]
+                record.memory_count = len(record.memory)
+            elif key in FIELDS:
+                setattr(record, key, value)
+            else:
+                record.set_extra(key, value)
+        return record
+
+    def set_extra(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def to_json(self):
+        data = {name: getattr(self, name) for name in FIELDS}
+        data["style"] = self.style.name if self.style is not None else None
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    @property
+    def style_name(self):
+        return self.style.name if self.style is not None else "Default"
+
+FIELDS = [field.name for field in dataclasses.fields(UserRecord) if field.name not in ("memory", "extra")]
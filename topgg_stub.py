@@ -0,0 +1,56 @@
+"""Local stand-in for the Top.gg API so vote handling can be tested offline.
+
+Run it, then start Aiko with TOPGG_API_URL pointing at it:
+
+    python topgg_stub.py --port 5001 --webhook http://127.0.0.1:8080/topgg --auth secret
+    TOPGG_API_URL=http://127.0.0.1:5001/api WEBHOOK_PORT=8080 TOPGG_WEBHOOK_AUTH=secret python main.py
+
+POST /stub/vote/<user_id> records a vote and pushes it to the bot's webhook like Top.gg would.
+"""
+import argparse
+import time
+
+import aiohttp
+from aiohttp import web
+
+VOTE_WINDOW = 12 * 3600
+
+def create_app(webhook_url=None, webhook_auth=None):
+    votes = {}  # user_id -> voted_at
+
+    async def check(request):
+        voted_at = votes.get(request.query.get("userId"))
+        voted = voted_at is not None and time.time() - voted_at < VOTE_WINDOW
+        return web.json_response({"voted": 1 if voted else 0})
+
+    async def stats(request):
+        payload = await request.json()
+        print(f"Bot {request.match_info['bot_id']} reported {payload.get('server_count')} servers")
+        return web.json_response({})
+
+    async def vote(request):
+        user_id = request.match_info["user_id"]
+        votes[user_id] = time.time()
+        pushed = None
+        if webhook_url:
+            payload = {"bot": request.query.get("bot", "0"), "user": user_id, "type": "upvote", "isWeekend": False, "query": ""}
+            headers = {"Authorization": webhook_auth} if webhook_auth else {}
+            async with aiohttp.ClientSession() as session:
+                async with session.post(webhook_url, json=payload, headers=headers) as response:
+                    pushed = response.status
+        return web.json_response({"user": user_id, "webhook_status": pushed})
+
+    app = web.Application()
+    app.router.add_get("/api/bots/{bot_id}/check", check)
+    app.router.add_post("/api/bots/{bot_id}/stats", stats)
+    app.router.add_post("/stub/vote/{user_id}", vote)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local Top.gg API stub.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--webhook", help="URL of the bot's Top.gg webhook to push votes to")
+    parser.add_argument("--auth", help="Authorization header sent with webhook pushes")
+    args = parser.parse_args()
+    web.run_app(create_app(args.webhook, args.auth), host=args.host, port=args.port)